@@ -1,15 +1,60 @@
 #Built in libraries
 import os
-import glob
+from fnmatch import fnmatch
 from pathlib import Path
 import re
 from shutil import move
 from shutil import copy
+from shutil import which
+from shutil import copyfileobj
+import subprocess
+import tempfile
+import signal
+import multiprocessing
+import threading
 from time import sleep
 from time import time
 import tarfile
+import posixpath
+import zipfile
+import gzip
+import bz2
+import lzma
+import io
+from contextlib import nullcontext
+from contextlib import ExitStack
+from abc import ABC
+from abc import abstractmethod
+import codecs
+import mmap
+import sys
 from sys import getfilesystemencoding
+import argparse
 import json
+import hashlib
+import heapq
+import bisect
+import zlib
+import html
+from xml.etree import ElementTree
+import sqlite3
+from collections import OrderedDict
+from collections import deque
+from collections import defaultdict
+from enum import Enum
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+    from re._casefix import _EXTRA_CASES as sre_extra_cases
+except ImportError: # Before Python 3.11
+    import sre_parse, sre_constants
+    from sre_compile import _ignorecase_fixes as sre_extra_cases
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource # POSIX only, used to cap the memory of the PDF extraction process
+except ImportError:
+    resource = None
 
 #Third party libraries
 import magic
@@ -17,25 +62,1777 @@ from tqdm import tqdm
 import openpyxl
 import xlrd
 from xlrd.sheet import ctype_text
-import docx
+from openpyxl.utils import get_column_letter, column_index_from_string
+from lxml import etree
 import PyPDF2
-import stopit
+import ahocorasick
+
+class KeywordMatcher:
+    """
+    Matches the full keyword list against a piece of text in a single pass.
+    Literal keywords are loaded into an Aho-Corasick automaton, regex keywords are combined into one alternation.
+    Matching is case insensitive, the same as the previous re.search(keyword, text, re.IGNORECASE) calls. Literals are
+    matched on text put through fold, which treats characters as equal in the same cases re.IGNORECASE does.
+    search_bytes runs the same keywords over raw UTF-8/ASCII bytes. Case folding there is ASCII only, non-ASCII literals
+    are matched in their lower, upper, capitalized and original forms. Unlike re it misses other mixes of case and
+    characters such as 'İ' or 'ſ' that re takes as 'i' or 's', so 'istanbul' doesn't match 'İSTANBUL' in raw bytes.
+    """
+    regex_characters = set(".^$*+?{}[]\\|()") # Keywords without any of these are treated as literals
+    # Characters re.IGNORECASE also takes as equal besides their lower case, like 'ſ' and 's' or 'ς' and 'σ', mapped to one of them
+    case_folds = {other: chr(min(character, *others)) for character, others in sre_extra_cases.items() for other in (character, *others) if other != min(character, *others)}
+    case_folded = re.compile("[{}]".format("".join(map(chr, case_folds)))) # Finds text that needs them, translate is slow
+    standalone_pattern = re.compile(r"\\\d|\(\?P=|^\(\?[aiLmsux]") # Backreferences and global flags can't live inside a combined alternation
+
+    def __init__(self, keywords):
+        self.keywords = set(keyword for keyword in keywords if keyword) # Empty keywords would match every line
+        self.literals = {} # Folded literal -> original keywords, more than one keyword can differ only by case
+        self.patterns = [] # (keyword, compiled pattern) checked after the combined alternation matches
+        self.standalone = [] # (keyword, compiled pattern) which always need to be checked on their own
+        for keyword in self.keywords:
+            if self.regex_characters.isdisjoint(keyword):
+                self.literals.setdefault(self.fold(keyword), set()).add(keyword)
+                continue
+            try:
+                pattern = re.compile(keyword, re.IGNORECASE)
+            except re.error:
+                # Not a valid regex, previously this failed every file. Search for it as plain text instead.
+                self.literals.setdefault(self.fold(keyword), set()).add(keyword)
+                continue
+            if self.standalone_pattern.search(keyword):
+                self.standalone.append((keyword, pattern))
+            else:
+                self.patterns.append((keyword, pattern))
+
+        self.automaton = None
+        if self.literals:
+            self.automaton = ahocorasick.Automaton()
+            for literal, originals in self.literals.items():
+                self.automaton.add_word(literal, tuple(originals))
+            self.automaton.make_automaton()
+
+        self.combined = None
+        if self.patterns:
+            try:
+                self.combined = re.compile("|".join("(?:{})".format(keyword) for keyword, _ in self.patterns), re.IGNORECASE)
+            except (re.error, OverflowError, RecursionError):
+                # Something like duplicate group names across keywords, fall back to checking each pattern
+                self.standalone.extend(self.patterns)
+                self.patterns = []
+        self._compile_bytes()
+        self._prefilter = None # (automaton, longest literal) built by might_match on first use, False when nothing can be ruled out
+
+    @classmethod
+    def fold(cls, text):
+        """
+        Lower cases text the way re.IGNORECASE compares it, one character for one. str.lower alone turns 'İ' in to two
+        characters where re takes it as 'i', and leaves pairs such as 'ſ' and 's' apart.
+        """
+        if text.isascii():
+            return text.lower()
+        text = text.replace("\u0130", "i").lower()
+        return text.translate(cls.case_folds) if cls.case_folded.search(text) else text
+
+    def search(self, text):
+        """
+        Returns the set of keywords found in the text.
+        """
+        found = set()
+        if self.automaton is not None:
+            for _, originals in self.automaton.iter(self.fold(text)):
+                found.update(originals)
+        if self.combined is not None and self.combined.search(text): # Most text matches none of the patterns, only then check them one by one
+            for keyword, pattern in self.patterns:
+                if pattern.search(text):
+                    found.add(keyword)
+        for keyword, pattern in self.standalone:
+            if pattern.search(text):
+                found.add(keyword)
+        return found
+
+    def required_literals(self):
+        """
+        Returns the folded text each keyword's hits have to contain, the keyword itself for literals and the longest run
+        of plain characters outside any group or repeat for patterns. None when a pattern has no such run, like 'a|b' or '\\d+'.
+        """
+        required = set(self.literals)
+        for keyword, _ in self.patterns + self.standalone:
+            try:
+                parsed = sre_parse.parse(keyword, re.IGNORECASE)
+            except Exception:
+                return None
+            longest, run = "", []
+            for op, argument in list(parsed) + [(None, None)]: # Every top level item has to match, in order
+                if op is sre_constants.LITERAL:
+                    run.append(chr(argument))
+                    continue
+                if len(run) > len(longest):
+                    longest = "".join(run)
+                run = []
+            if not longest:
+                return None
+            required.add(self.fold(longest))
+        return required
+
+    def might_match(self, pieces):
+        """
+        Cheap check over an iterable of text pieces that follow on from each other, for the literal text in required_literals.
+        Returns False only when no keyword can have a hit in the text. A piece of None means the text can't be vouched for.
+        """
+        if self._prefilter is None:
+            required = self.required_literals()
+            if not required:
+                self._prefilter = False
+            else:
+                automaton = ahocorasick.Automaton()
+                for literal in required:
+                    automaton.add_word(literal, literal)
+                automaton.make_automaton()
+                self._prefilter = (automaton, max(len(literal) for literal in required))
+        if self._prefilter is False:
+            return True
+        automaton, longest = self._prefilter
+        tail = ""
+        for piece in pieces:
+            if piece is None:
+                return True
+            text = tail + self.fold(piece)
+            for _ in automaton.iter(text):
+                return True
+            tail = text[max(0, len(text) - longest + 1):] if longest > 1 else "" # A literal split between pieces, or over several short ones
+        return False
+
+    def _compile_bytes(self):
+        """
+        Builds the bytes versions of the automaton and patterns. Patterns that would match differently over raw bytes than over
+        decoded lines, see _bytes_safe, leave bytes_capable False and callers should decode line by line and use search instead.
+        """
+        self.bytes_capable = True
+        self.max_literal_bytes = 0
+        self.bytes_automaton = None
+        if self.literals:
+            variants = {} # Latin-1 view of the ASCII lower cased UTF-8 bytes -> original keywords
+            for literal, originals in self.literals.items():
+                forms = {literal, literal.upper(), literal.capitalize()} | originals
+                for form in forms:
+                    if not re.fullmatch(re.escape(literal), form, re.IGNORECASE): # str.upper turns 'ß' in to 'SS', which re doesn't
+                        continue
+                    key = form.encode('utf-8').lower().decode('latin-1')
+                    variants.setdefault(key, set()).update(originals)
+            self.bytes_automaton = ahocorasick.Automaton()
+            for key, originals in variants.items():
+                self.bytes_automaton.add_word(key, (len(key), tuple(originals)))
+                self.max_literal_bytes = max(self.max_literal_bytes, len(key))
+            self.bytes_automaton.make_automaton()
+
+        self.bytes_patterns = []
+        self.bytes_standalone = []
+        self.bytes_combined = None
+        for keyword, _ in self.patterns + self.standalone:
+            try:
+                safe = keyword.isascii() and self._bytes_safe(sre_parse.parse(keyword, re.IGNORECASE))
+            except Exception:
+                safe = False
+            if not safe:
+                self.bytes_capable = False
+                return
+        self.bytes_patterns = [(keyword, re.compile(keyword.encode('ascii'), re.IGNORECASE | re.MULTILINE)) for keyword, _ in self.patterns]
+        self.bytes_standalone = [(keyword, re.compile(keyword.encode('ascii'), re.IGNORECASE | re.MULTILINE)) for keyword, _ in self.standalone]
+        if self.combined is not None:
+            self.bytes_combined = re.compile(self.combined.pattern.encode('ascii'), re.IGNORECASE | re.MULTILINE) # Lines are no longer matched one at a time, anchors have to work per line
+
+    # Pattern items that match the same over UTF-8 bytes as over a decoded line: plain characters, repeats, groups, alternatives,
+    # ^ (per line) and backreferences. '.', classes, \\w, \\s, \\b and the like see single bytes instead of characters,
+    # \\A and \\Z would anchor to the window, and anything that can take a newline could match across lines. $ only matches
+    # before a '\\n' in bytes, where a line read as text also ends at '\\r\\n'.
+    bytes_safe_anchors = (sre_constants.AT_BEGINNING,)
+
+    @classmethod
+    def _bytes_safe(cls, items):
+        for op, argument in items:
+            if op is sre_constants.LITERAL:
+                if argument > 127 or argument in (10, 13):
+                    return False
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or op is getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+                if not cls._bytes_safe(argument[2]):
+                    return False
+            elif op is sre_constants.SUBPATTERN:
+                if not cls._bytes_safe(argument[3]):
+                    return False
+            elif op is sre_constants.BRANCH:
+                if not all(cls._bytes_safe(branch) for branch in argument[1]):
+                    return False
+            elif op is sre_constants.AT:
+                if argument not in cls.bytes_safe_anchors:
+                    return False
+            elif op is not sre_constants.GROUPREF:
+                return False
+        return True
+
+    def search_bytes(self, data):
+        """
+        Returns (start, end, keyword) for the hits in a block of bytes. Patterns report at most their first hit on each line.
+        """
+        hits = []
+        if self.bytes_automaton is not None:
+            for end, (length, originals) in self.bytes_automaton.iter(data.lower().decode('latin-1')):
+                for keyword in originals:
+                    hits.append((end - length + 1, end + 1, keyword))
+        if self.bytes_combined is not None and self.bytes_combined.search(data):
+            for keyword, pattern in self.bytes_patterns:
+                hits.extend(self._line_matches(keyword, pattern, data))
+        for keyword, pattern in self.bytes_standalone:
+            hits.extend(self._line_matches(keyword, pattern, data))
+        return hits
+
+    @staticmethod
+    def _line_matches(keyword, pattern, data):
+        # Searching again from the next line keeps patterns that match everywhere, like 'a*', from producing a hit per byte
+        position = 0
+        while True:
+            match = pattern.search(data, position)
+            if match is None:
+                return
+            yield match.start(), match.end(), keyword
+            position = data.find(b"\n", match.start()) + 1
+            if position == 0:
+                return
+
+class ResultsSink(ABC):
+    """
+    Base class for the places search results get written to.
+    Records are buffered by the backends and flushed in batches, on close and whenever flush_interval seconds have passed.
+    """
+    def __init__(self, flush_interval=30):
+        self.flush_interval = flush_interval # Seconds between flushes
+        self.last_flush = time()
+
+    @abstractmethod
+    def write(self, keyword, path, context, location=None):
+        """
+        Records one hit. location is where in the file it was, such as 'line 3' or 'page 2', or None.
+        """
+
+    def write_many(self, records):
+        """
+        Writes an iterable of (keyword, path, context, location) records.
+        """
+        for record in records:
+            self.write(*record)
+
+    def _maybe_flush(self):
+        if time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time()
+
+    def close(self):
+        self.flush()
+
+class MemorySink(ResultsSink):
+    """
+    Holds results in memory, used by worker processes to hand their hits back to the process writing the results.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def write(self, keyword, path, context, location=None):
+        self.records.append((keyword, path, context, location))
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+class KeywordFileSink(ResultsSink):
+    """
+    Writes results to one text file per keyword, 'Results/<keyword>.txt', the original layout with the location of the hit,
+    such as the line, sheet and cell or paragraph, after the path: 'path [location]---context'.
+    Keeps a bounded pool of buffered handles open rather than opening the file for every hit.
+    """
+    unsafe_characters = re.compile(r'[<>:"/\\|?*\x00-\x1f]') # Not allowed in a filename on Windows, '/' on everything else
+
+    def __init__(self, results_dir, max_open_files=64, buffer_size=1024 * 1024, flush_interval=30):
+        super().__init__(flush_interval)
+        self.results_dir = results_dir
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.handles = OrderedDict() # keyword -> open file, least recently used first
+
+    @classmethod
+    def keyword_filename(cls, keyword):
+        """
+        Builds a file name for the keyword. Keywords that aren't legal file names get the offending characters replaced
+        plus a short hash of the keyword so two different keywords never share a results file.
+        """
+        safe_keyword = cls.unsafe_characters.sub("_", keyword).strip(" .")[:100]
+        if safe_keyword != keyword:
+            safe_keyword = "{}_{}".format(safe_keyword, hashlib.sha1(keyword.encode('utf-8')).hexdigest()[:8])
+        return safe_keyword + ".txt"
+
+    def _handle(self, keyword):
+        handle = self.handles.get(keyword)
+        if handle is not None:
+            self.handles.move_to_end(keyword)
+            return handle
+        if len(self.handles) >= self.max_open_files:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        keyword_result_file = os.path.join(self.results_dir, self.keyword_filename(keyword))
+        handle = open(keyword_result_file, 'a', encoding='utf-8', errors='replace', buffering=self.buffer_size)
+        self.handles[keyword] = handle
+        return handle
+
+    def write(self, keyword, path, context, location=None):
+        handle = self._handle(keyword)
+        handle.write(path + (" [{}]".format(location) if location else "") + "---" + context)
+        if not context.endswith("\n"):
+            handle.write("\n")
+        self._maybe_flush()
+
+    def flush(self):
+        for handle in self.handles.values():
+            handle.flush()
+        super().flush()
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+class JsonlSink(ResultsSink):
+    """
+    Writes every result to a single JSON lines file with keyword, path, location and context fields.
+    """
+    def __init__(self, results_file, buffer_size=1024 * 1024, flush_interval=30):
+        super().__init__(flush_interval)
+        self.results_file = results_file
+        self.handle = open(results_file, 'a', encoding='utf-8', buffering=buffer_size)
+
+    def write(self, keyword, path, context, location=None):
+        record = {'keyword': keyword, 'path': path, 'location': location, 'context': context.rstrip("\n")}
+        self.handle.write(json.dumps(record, ensure_ascii=False))
+        self.handle.write("\n")
+        self._maybe_flush()
+
+    def flush(self):
+        self.handle.flush()
+        super().flush()
+
+    def close(self):
+        self.handle.close()
+
+class SqliteSink(ResultsSink):
+    """
+    Writes every result to a single SQLite database, inserted in batches.
+    """
+    def __init__(self, results_file, batch_size=10000, flush_interval=30):
+        super().__init__(flush_interval)
+        self.results_file = results_file
+        self.batch_size = batch_size
+        self.pending = []
+        self.connection = sqlite3.connect(results_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (keyword TEXT, path TEXT, location TEXT, context TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_keyword ON results (keyword)")
+        self.connection.commit()
+
+    def write(self, keyword, path, context, location=None):
+        self.pending.append((keyword, path, location, context.rstrip("\n")))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        else:
+            self._maybe_flush()
+
+    def flush(self):
+        if self.pending:
+            self.connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?)", self.pending)
+            self.connection.commit()
+            self.pending = []
+        super().flush()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+class RunLog:
+    """
+    Structured log for a run, one JSON record per line with the event, stage, path, duration and error.
+    Keeps a single buffered handle open instead of opening the log for every event.
+    Verbosity is one of 'error' (failures only), 'info' (adds run level events) or 'debug' (adds a line for every file handled).
+    Without a log file the records are held in memory until drained, which is how worker processes pass them back.
+    """
+    levels = {'error': 0, 'info': 1, 'debug': 2}
+
+    def __init__(self, log_file, verbosity='info', buffer_size=256 * 1024, flush_interval=30):
+        if verbosity not in self.levels:
+            raise ValueError("verbosity must be one of {}".format(", ".join(self.levels)))
+        self.log_file = log_file
+        self.level = self.levels[verbosity]
+        self.flush_interval = flush_interval # Seconds between flushes
+        self.last_flush = time()
+        self.records = []
+        self.handle = None
+        if log_file is not None:
+            self.handle = open(log_file, 'a', encoding='utf-8', errors='replace', buffering=buffer_size)
+
+    def write(self, level, event, stage, path=None, duration=None, error=None, **extra):
+        """
+        Writes one record if the level is enabled. 
+        """
+        if self.levels[level] > self.level:
+            return
+        record = {'time': round(time(), 3), 'level': level, 'event': event, 'stage': stage}
+        if path is not None:
+            record['path'] = path
+        if duration is not None:
+            record['duration'] = round(duration, 6)
+        if error is not None:
+            record['error'] = str(error)
+        record.update(extra)
+        if self.handle is None:
+            self.records.append(record)
+        else:
+            self.write_records([record])
+
+    def write_records(self, records):
+        """
+        Writes records that were already built, such as the ones drained from a worker process.
+        """
+        for record in records:
+            self.handle.write(json.dumps(record, ensure_ascii=False, default=str))
+            self.handle.write("\n")
+        if time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+    def success(self, stage, path=None, duration=None, level='debug', **extra):
+        if self.levels[level] <= self.level: # Checked here as well so the hot path doesn't build a record that gets thrown away
+            self.write(level, 'success', stage, path, duration, **extra)
+
+    def failure(self, stage, path=None, error=None, duration=None, **extra):
+        self.write('error', 'failure', stage, path, duration, error, **extra)
+
+    def info(self, event, stage, path=None, duration=None, **extra):
+        if self.level >= 1:
+            self.write('info', event, stage, path, duration, **extra)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.flush()
+        self.last_flush = time()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+
+class RunMetrics:
+    """
+    Optional instrumentation for process_directory. Keeps a count, total and latency histogram for every stage, broken down by
+    detected file type, a count of files by type and disposition, and the slowest files with the time each stage took for them.
+    Snapshots are written to a JSON file, or a Prometheus text file when the name ends in '.prom', every interval seconds.
+    """
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300) # Upper bounds in seconds, anything slower goes in +Inf
+
+    def __init__(self, metrics_file, top_files=20, interval=60):
+        self.metrics_file = metrics_file
+        self.top_files = top_files
+        self.interval = interval # Seconds between snapshots
+        self.started = time()
+        self.last_write = time()
+        self.stages = {} # (stage, file type) -> [count, total seconds, max seconds, count per bucket]
+        self.files = {} # (file type, disposition) -> count
+        self.slowest = [] # Min heap of (seconds, path, file type, {stage: seconds}), at most top_files long
+
+    def observe(self, stage, seconds, filetype='all'):
+        """
+        Adds one timing for a stage.
+        """
+        entry = self.stages.get((stage, filetype))
+        if entry is None:
+            entry = self.stages[(stage, filetype)] = [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def file_done(self, path, filetype, status, stages):
+        """
+        Records the stages timed for one file and keeps it if it's among the slowest.
+        """
+        total = sum(stages.values())
+        for stage, seconds in stages.items():
+            self.observe(stage, seconds, filetype)
+        self.observe('total', total, filetype)
+        self.files[(filetype, status)] = self.files.get((filetype, status), 0) + 1
+        if len(self.slowest) < self.top_files:
+            heapq.heappush(self.slowest, (total, path, filetype, stages))
+        elif total > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (total, path, filetype, stages))
+
+    def slowest_files(self):
+        """
+        Returns the slowest files, slowest first, as dictionaries with the path, file type, total seconds and the seconds per stage.
+        """
+        return [{'path': path, 'type': filetype, 'seconds': round(total, 6), 'stages': {stage: round(seconds, 6) for stage, seconds in stages.items()}}
+                for total, path, filetype, stages in sorted(self.slowest, key=lambda item: item[0], reverse=True)]
+
+    def snapshot(self):
+        stages = {}
+        for (stage, filetype), (count, total, longest, counts) in sorted(self.stages.items()):
+            stages.setdefault(stage, {})[filetype] = {
+                'count': count, 'seconds': round(total, 6), 'max': round(longest, 6),
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], counts)),
+            }
+        files = {}
+        for (filetype, status), count in sorted(self.files.items()):
+            files.setdefault(filetype, {})[status] = count
+        return {'time': round(time(), 3), 'elapsed': round(time() - self.started, 3), 'stages': stages, 'files': files, 'slowest': self.slowest_files()}
+
+    def prometheus(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        def labels(**values):
+            return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in values.items()) + "}"
+        lines = ["# HELP filesearcher_stage_seconds Time spent in each stage of process_directory.", "# TYPE filesearcher_stage_seconds histogram"]
+        for (stage, filetype), (count, total, _, counts) in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip([str(bound) for bound in self.buckets] + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append("filesearcher_stage_seconds_bucket{} {}".format(labels(stage=stage, type=filetype, le=bound), cumulative))
+            lines.append("filesearcher_stage_seconds_sum{} {}".format(labels(stage=stage, type=filetype), repr(total)))
+            lines.append("filesearcher_stage_seconds_count{} {}".format(labels(stage=stage, type=filetype), count))
+        lines += ["# HELP filesearcher_files_total Files handled by type and disposition.", "# TYPE filesearcher_files_total counter"]
+        for (filetype, status), count in sorted(self.files.items()):
+            lines.append("filesearcher_files_total{} {}".format(labels(type=filetype, status=status), count))
+        lines += ["# HELP filesearcher_slowest_file_seconds Time each stage took for the slowest files.", "# TYPE filesearcher_slowest_file_seconds gauge"]
+        for item in self.slowest_files():
+            for stage, seconds in list(item['stages'].items()) + [('total', item['seconds'])]:
+                lines.append("filesearcher_slowest_file_seconds{} {}".format(labels(path=item['path'], type=item['type'], stage=stage), seconds))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Writes a snapshot, replacing the previous one in a single step.
+        """
+        if self.metrics_file.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=1, ensure_ascii=False)
+        temporary = self.metrics_file + ".tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(temporary, self.metrics_file)
+        self.last_write = time()
+
+    def maybe_write(self):
+        if time() - self.last_write >= self.interval:
+            self.write()
+
+class DispositionReport:
+    """
+    What a read only scan writes instead of moving files, one JSON record per line with the path and its disposition.
+    Paths are written exactly as they are on disk, names that aren't valid UTF-8 keep their original bytes.
+    """
+    def __init__(self, report_file, buffer_size=256 * 1024):
+        self.report_file = report_file
+        self.handle = open(report_file, 'a', encoding='utf-8', errors='surrogateescape', buffering=buffer_size)
+
+    def record(self, path, status, **extra):
+        record = {'time': round(time(), 3), 'path': path, 'status': status}
+        record.update(extra)
+        self.handle.write(json.dumps(record, ensure_ascii=False))
+        self.handle.write("\n")
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+class ScanManifest:
+    """
+    Persistent record of every file a run has dealt with, kept in SQLite under the output directory.
+    Keyed by path, it stores the size, mtime, optional content hash, disposition and the set of keywords the file was searched for.
+    Changes are written in batches by flush, which the searcher only calls after the results have been flushed,
+    so a file recorded here always has its results on disk. Files that were in flight during a crash are searched again.
+    """
+    final_statuses = ('processed', 'error', 'unsupported')
+
+    def __init__(self, manifest_file, use_hash=False):
+        self.manifest_file = manifest_file
+        self.use_hash = use_hash # Also compare a content hash, catches changes that keep the size and mtime
+        self.pending = {} # path -> row waiting for the next flush
+        self.keyword_sets = {} # version -> frozenset of keywords
+        self.connection = sqlite3.connect(manifest_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, source TEXT, size INTEGER, mtime REAL, hash TEXT, status TEXT, keyword_version TEXT, updated REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS keyword_sets (version TEXT PRIMARY KEY, keywords TEXT)")
+        self.connection.commit()
+
+    @staticmethod
+    def keyword_version(keywords):
+        """
+        Stable identifier for a set of keywords.
+        """
+        return hashlib.sha1("\n".join(sorted(keywords)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def file_hash(filename, chunk_size=1024 * 1024):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(long_path(filename), 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _register_keywords(self, keywords):
+        version = self.keyword_version(keywords)
+        if version not in self.keyword_sets:
+            self.keyword_sets[version] = frozenset(keywords)
+            self.connection.execute("INSERT OR IGNORE INTO keyword_sets VALUES (?, ?)", (version, json.dumps(sorted(keywords))))
+        return version
+
+    def keywords_for(self, version):
+        """
+        Returns the keyword set recorded under a version.
+        """
+        if version not in self.keyword_sets:
+            row = self.connection.execute("SELECT keywords FROM keyword_sets WHERE version = ?", (version,)).fetchone()
+            self.keyword_sets[version] = frozenset(json.loads(row[0])) if row else frozenset()
+        return self.keyword_sets[version]
+
+    def lookup(self, path):
+        """
+        Returns the row recorded for the path as a dictionary, or None.
+        """
+        if path in self.pending:
+            row = self.pending[path]
+        else:
+            row = self.connection.execute("SELECT path, source, size, mtime, hash, status, keyword_version, updated FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return None
+        return dict(zip(('path', 'source', 'size', 'mtime', 'hash', 'status', 'keyword_version', 'updated'), row))
+
+    def keywords_needed(self, path, size, mtime, keywords, digest=None):
+        """
+        Works out what still has to be searched for in a file. 
+        Returns every keyword for new, changed or interrupted files, only the keywords it hasn't been searched for yet
+        for files that are already done, or None when the file can be skipped.
+        """
+        row = self.lookup(path)
+        if row is None or row['status'] not in self.final_statuses:
+            return frozenset(keywords)
+        if row['size'] != size or row['mtime'] != mtime or (digest and row['hash'] and digest != row['hash']):
+            return frozenset(keywords)
+        if row['status'] != 'processed': # Unsupported and error files won't search any differently with new keywords
+            return None
+        missing = frozenset(keywords) - self.keywords_for(row['keyword_version'])
+        return missing or None
+
+    def record(self, path, source, size, mtime, digest, status, keywords):
+        """
+        Queues the outcome for a file, written out by the next flush.
+        """
+        version = self._register_keywords(keywords)
+        self.pending[path] = (path, source, size, mtime, digest, status, version, time())
+
+    def flush(self):
+        if self.pending:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", list(self.pending.values()))
+            self.pending = {}
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+class MemoryIndex:
+    """
+    Holds extracted text in memory, used by worker processes to hand it back to the process writing the index.
+    """
+    def __init__(self):
+        self.segments = []
+
+    def add(self, path, location, text, first_line=None):
+        self.segments.append((path, location, text, first_line))
+
+    def drain(self):
+        segments, self.segments = self.segments, []
+        return segments
+
+class TextIndex:
+    """
+    On disk index of the text the parsers extract, so a new keyword list can be answered without parsing the files again.
+    Text is kept in SQLite as segments, a cell, paragraph or page, or a block of lines for plain text, each with its path and location.
+    An FTS5 trigram index over the segments finds the candidates for literal keywords of three or more characters,
+    the KeywordMatcher then confirms them so the hits are the same as a scan. Regex and shorter keywords are matched against every segment.
+    A file that is indexed again has its old segments replaced.
+    """
+    def __init__(self, index_file, batch_size=10000):
+        self.index_file = index_file
+        self.batch_size = batch_size
+        self.pending = []
+        self.current_file = (None, None) # (path, id) of the file being written, a file's segments always arrive together
+        self.connection = sqlite3.connect(index_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, indexed REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, file_id INTEGER, location TEXT, first_line INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS segments_file ON segments (file_id)")
+        self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS segment_text USING fts5(text, tokenize='trigram')") # Needs SQLite 3.34 or later
+        self.connection.commit()
+
+    def add(self, path, location, text, first_line=None):
+        """
+        Queues a segment of extracted text. first_line is set for blocks of plain text lines, which are matched line by line.
+        """
+        self.pending.append((path, location, text, first_line))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, segments):
+        for segment in segments:
+            self.add(*segment)
+
+    def _file_id(self, path):
+        if path == self.current_file[0]:
+            return self.current_file[1]
+        row = self.connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            file_id = self.connection.execute("INSERT INTO files (path, indexed) VALUES (?, ?)", (path, time())).lastrowid
+        else:
+            file_id = row[0]
+            self.connection.execute("DELETE FROM segment_text WHERE rowid IN (SELECT id FROM segments WHERE file_id = ?)", (file_id,))
+            self.connection.execute("DELETE FROM segments WHERE file_id = ?", (file_id,))
+            self.connection.execute("UPDATE files SET indexed = ? WHERE id = ?", (time(), file_id))
+        self.current_file = (path, file_id)
+        return file_id
+
+    def flush(self):
+        for path, location, text, first_line in self.pending:
+            segment_id = self.connection.execute("INSERT INTO segments (file_id, location, first_line) VALUES (?, ?, ?)", (self._file_id(path), location, first_line)).lastrowid
+            self.connection.execute("INSERT INTO segment_text (rowid, text) VALUES (?, ?)", (segment_id, text))
+        self.pending = []
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def search(self, keywords):
+        """
+        Generator of (keyword, path, context, location) records for the keywords, the same records a scan writes to the results.
+        """
+        indexed = set() # Keywords the trigram index can narrow down
+        scanned = set()
+        for keyword in set(keywords):
+            if keyword and KeywordMatcher.regex_characters.isdisjoint(keyword) and len(keyword) >= 3:
+                indexed.add(keyword)
+            elif keyword:
+                scanned.add(keyword)
+        query = "SELECT files.path, segments.location, segments.first_line, segment_text.text FROM segment_text JOIN segments ON segments.id = segment_text.rowid JOIN files ON files.id = segments.file_id"
+        for keyword in sorted(indexed):
+            rows = self.connection.execute(query + " WHERE segment_text MATCH ? ORDER BY segments.id", ('"{}"'.format(keyword.replace('"', '""')),))
+            yield from self._matching(KeywordMatcher([keyword]), rows)
+        if scanned:
+            yield from self._matching(KeywordMatcher(scanned), self.connection.execute(query + " ORDER BY segments.id"))
+
+    @staticmethod
+    def _matching(matcher, rows):
+        for path, location, first_line, text in rows:
+            if first_line is None:
+                for keyword in matcher.search(text):
+                    yield keyword, path, text, location
+                continue
+            for line_number, line in enumerate(text.split("\n"), start=first_line):
+                for keyword in matcher.search(line):
+                    yield keyword, path, line, "line {}".format(line_number)
+
+class ExtractCache:
+    """
+    Cache of the text extracted from the formats that are slow to parse, kept on local disk as one zlib compressed file per entry.
+    Entries are keyed by a hash of the file content and the parser, so copies in different folders and files searched again
+    after a keyword change or a crash are parsed once. Reading an entry bumps its mtime, and when the cache grows past
+    max_size the least recently used entries are removed. Several processes can share the directory, entries are
+    written to a temporary file and renamed in to place.
+    """
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_entry_size = max_size // 16 # Characters of text, larger documents aren't cached
+        self.hits = 0
+        self.misses = 0
+        self.written = 0 # Bytes written since the size was last worked out
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = self.trim()
+
+    @staticmethod
+    def key(parser, filename, fileobj=None, chunk_size=1024 * 1024):
+        """
+        Builds the key for a file from its content, read from fileobj when given and left at the start for the parser.
+        """
+        digest = hashlib.blake2b(parser.encode('utf-8'), digest_size=20)
+        with open(filename, 'rb') if fileobj is None else nullcontext(fileobj) as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+            if fileobj is not None:
+                file.seek(0)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json.z")
+
+    def get(self, key):
+        """
+        Returns the cached list of (location, text) segments, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                segments = json.loads(zlib.decompress(file.read()).decode('utf-8'))
+            os.utime(path)
+        except (OSError, ValueError, zlib.error): # Missing, or evicted or damaged by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(segment) for segment in segments]
+
+    def put(self, key, segments):
+        path = self._path(key)
+        data = zlib.compress(json.dumps(segments, ensure_ascii=False).encode('utf-8'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+        self.written += len(data)
+
+    def drain(self):
+        """
+        Returns and resets (hits, misses, bytes written), which is how worker processes pass their counts back.
+        """
+        counts = (self.hits, self.misses, self.written)
+        self.hits, self.misses, self.written = 0, 0, 0
+        return counts
+
+    def merge(self, counts):
+        """
+        Adds the counts drained from a worker.
+        """
+        hits, misses, written = counts
+        self.hits += hits
+        self.misses += misses
+        self.written += written
+
+    def maybe_trim(self):
+        """
+        Evicts entries once the cache may have grown past max_size, only one process should call this.
+        """
+        if self.size + self.written > self.max_size:
+            self.size = self.trim()
+
+    def trim(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size. Returns the size left.
+        """
+        entries = []
+        for directory in os.scandir(self.cache_dir):
+            if directory.is_dir():
+                for entry in os.scandir(directory.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        entries.sort()
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+        self.written = 0
+        return size
+
+class PdfExtractor:
+    """
+    Extracts PDF text in a separate process that can be killed, so a PDF that hangs or eats memory inside a parser
+    only costs that file. Pages are handed back one at a time as they are extracted.
+    The process is reused from file to file and started again after it has been killed or died.
+    backend is 'pypdf2', 'pdftotext' (poppler-utils) or 'auto' for pdftotext when it is installed.
+    timeout and page_timeout are seconds for the whole file and between pages. memory_limit is bytes of address space on top of
+    what the process starts with, POSIX only.
+    """
+    backends = ('pypdf2', 'pdftotext', 'auto')
+
+    def __init__(self, backend='pypdf2', timeout=600, page_timeout=20, memory_limit=2 * 1024 * 1024 * 1024):
+        if backend not in self.backends:
+            raise ValueError("backend must be one of {}".format(", ".join(self.backends)))
+        if backend == 'auto':
+            backend = 'pdftotext' if which('pdftotext') else 'pypdf2'
+        self.backend = backend
+        self.timeout = timeout
+        self.page_timeout = page_timeout
+        self.memory_limit = memory_limit
+        self.process = None
+        self.connection = None
+
+    def _start(self):
+        # Spawned rather than forked, a forked copy would hold on to whatever pipes its parent has, including the sentinel
+        # a worker pool uses to notice the worker died
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_pdf_extraction_loop, args=(child_connection, self.memory_limit), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def stop(self, kill=False):
+        """
+        Ends the extraction process, kill=True for one that may be stuck.
+        """
+        if self.process is None:
+            return
+        if kill:
+            if hasattr(os, 'killpg'):
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL) # Takes pdftotext down with it
+                except OSError:
+                    pass
+            self.process.kill()
+        else:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(5)
+        self.connection.close()
+        self.process = None
+        self.connection = None
+
+    def pages(self, filename, fileobj=None):
+        """
+        Generator of (page number, text). Raises TimeoutError when the file or a page takes too long, after killing the process.
+        A file on disk is opened by the extraction process from its path, only in memory streams such as archive members are sent over.
+        """
+        if self.process is None or not self.process.is_alive():
+            self.stop(kill=True)
+            self._start()
+        if fileobj is not None and type(fileobj) is io.BufferedReader and isinstance(fileobj.raw, io.FileIO):
+            filename, fileobj = fileobj.name, None # The path it was opened with, which may differ from the one in the results
+        data = fileobj.read() if fileobj is not None else None
+        self.connection.send((self.backend, filename if fileobj is None else None, data))
+        deadline = time() + self.timeout
+        finished = False
+        try:
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0 or not self.connection.poll(min(self.page_timeout, remaining)):
+                    if deadline - time() <= 0:
+                        raise TimeoutError("PDF extraction took longer than {} seconds.".format(self.timeout))
+                    raise TimeoutError("No page extracted from the PDF in {} seconds.".format(self.page_timeout))
+                try:
+                    message = self.connection.recv()
+                except EOFError:
+                    raise RuntimeError("PDF extraction process died, exit code {}.".format(self.process.exitcode))
+                if message[0] == 'page':
+                    yield message[1], message[2]
+                elif message[0] == 'error':
+                    finished = True
+                    raise RuntimeError(message[1])
+                else:
+                    finished = True
+                    return
+        finally:
+            if not finished: # Timed out, died, or the caller stopped reading part way through
+                self.stop(kill=True)
+
+def _pdf_extraction_loop(connection, memory_limit):
+    """
+    Runs in the PDF extraction process, extracting one file per request until it gets None or the process that started it goes away.
+    """
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp() # Own process group, so a kill reaches pdftotext as well
+    if memory_limit and resource is not None:
+        in_use = 0
+        if os.path.exists("/proc/self/statm"): # A forked process starts out with its parent's address space
+            with open("/proc/self/statm") as statm:
+                in_use = int(statm.read().split()[0]) * resource.getpagesize()
+        resource.setrlimit(resource.RLIMIT_AS, (in_use + memory_limit, in_use + memory_limit))
+    parent = multiprocessing.parent_process()
+    while True:
+        while not connection.poll(1):
+            if parent is not None and not parent.is_alive():
+                return
+        try:
+            request = connection.recv()
+        except EOFError: # The other end was closed
+            return
+        if request is None:
+            return
+        backend, filename, data = request
+        try:
+            if backend == 'pdftotext':
+                pages = _pdftotext_pages(filename, data)
+            else:
+                pages = _pypdf2_pages(filename, data)
+            for page_number, text in pages:
+                connection.send(('page', page_number, text))
+            connection.send(('done',))
+        except Exception as e:
+            connection.send(('error', "{}: {}".format(type(e).__name__, e)))
+
+def _pypdf2_pages(filename, data):
+    with open(filename, 'rb') if data is None else nullcontext(io.BytesIO(data)) as pdf_file:
+        read_pdf = PyPDF2.PdfFileReader(pdf_file, strict=False) ##Read and supress warnings
+        if read_pdf.isEncrypted:
+            raise ValueError("File is encrypted, unable to parse.")
+        for page_number in range(read_pdf.getNumPages()):
+            yield page_number + 1, read_pdf.getPage(page_number).extractText()
+
+def _pdftotext_pages(filename, data):
+    # pdftotext ends every page with a form feed, pages are passed on as soon as they are complete
+    with tempfile.NamedTemporaryFile(suffix=".pdf") if data is not None else nullcontext() as temporary:
+        if data is not None:
+            temporary.write(data)
+            temporary.flush()
+            filename = temporary.name
+        process = subprocess.Popen(["pdftotext", "-layout", "-enc", "UTF-8", filename, "-"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        errors = deque(maxlen=20) # Drained as it comes so a chatty PDF can't fill the pipe and stall pdftotext, the last lines are kept
+        drain = threading.Thread(target=errors.extend, args=(process.stderr,), daemon=True)
+        drain.start()
+        page_number = 1
+        page = []
+        for line in codecs.getreader('utf-8')(process.stdout, errors='replace'):
+            while "\f" in line:
+                before, line = line.split("\f", 1)
+                page.append(before)
+                yield page_number, "".join(page)
+                page_number += 1
+                page = []
+            page.append(line)
+        if "".join(page).strip():
+            yield page_number, "".join(page)
+        drain.join()
+        error = b"".join(errors).decode('utf-8', errors='replace').strip()
+        if process.wait() != 0:
+            raise RuntimeError("pdftotext failed: {}".format(error))
+
+class FileType(Enum):
+    """
+    File types the searcher knows how to handle, shared by the classifier, the dispatcher and the parsers.
+    """
+    TEXT = 'text'
+    XLSX = 'xlsx'
+    XLS = 'xls'
+    DOCX = 'docx'
+    PDF = 'pdf'
+    TAR = 'tar'
+    GZIP = 'gzip'
+    BZIP2 = 'bzip2'
+    XZ = 'xz'
+    ZIP = 'zip'
+    UNKNOWN = 'unknown'
+
+    @property
+    def is_archive(self):
+        return self in (FileType.TAR, FileType.GZIP, FileType.BZIP2, FileType.XZ, FileType.ZIP)
+
+class FileClassifier:
+    """
+    Works out the FileType from the first few KB of a file, which the caller reads once and keeps using for the parse.
+    Cheap built in signatures are checked first, libmagic only sees headers none of them match. 
+    libmagic results are cached by a fingerprint of the header.
+    """
+    header_size = 8192 # Bytes callers should pass in
+    cfb_signature = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1" # Compound File Binary, legacy office documents
+    mime_types = {
+        FileType.XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        FileType.XLS: "application/vnd.ms-excel",
+        FileType.DOCX: "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        FileType.PDF: "application/pdf",
+        FileType.TAR: "application/x-tar",
+        FileType.GZIP: "application/gzip",
+        FileType.BZIP2: "application/x-bzip2",
+        FileType.XZ: "application/x-xz",
+        FileType.ZIP: "application/zip",
+    }
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # header fingerprint -> (FileType, mime type), least recently used first
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def classify(self, header, filename="", fileobj=None):
+        """
+        Returns the FileType for a header. fileobj, when given, has to be seekable and is only used to look inside zip files.
+        filename is only looked at for its extension, for an archive member it is the member's name.
+        """
+        if header[len(codecs.BOM_UTF8) if header.startswith(codecs.BOM_UTF8) else 0:].lstrip().startswith(b"%PDF-"):
+            return FileType.PDF
+        if header.startswith(b"\x1f\x8b"):
+            return FileType.GZIP
+        if header.startswith(b"BZh") and header[3:4].isdigit():
+            return FileType.BZIP2
+        if header.startswith(b"\xfd7zXZ\x00"):
+            return FileType.XZ
+        if header[257:262] == b"ustar":
+            return FileType.TAR
+        if header.startswith(b"PK\x03\x04") or header.startswith(b"PK\x05\x06"):
+            return self._zip_type(header, fileobj)
+        if header.startswith(self.cfb_signature):
+            # Legacy office documents all share the container, libmagic sometimes names the application
+            if filename.lower().endswith(".xls") or "Excel" in self._describe(header)[0]:
+                return FileType.XLS
+            return FileType.UNKNOWN
+        description = self._describe(header)[0]
+        if description.startswith("PDF document"): # libmagic also finds the PDF header behind some junk
+            return FileType.PDF
+        if "text" in description.lower():
+            return FileType.TEXT
+        if "Microsoft Excel 2007+" in description:
+            return FileType.XLSX
+        if "Microsoft Word 2007+" in description:
+            return FileType.DOCX
+        if "tar archive" in description.lower(): # Old tar formats without the ustar magic
+            return FileType.TAR
+        return FileType.UNKNOWN
+
+    def mime(self, header, filetype=None):
+        """
+        Returns the mime type for a header, from the signature when there is one, otherwise from libmagic.
+        """
+        filetype = filetype or self.classify(header)
+        if filetype in self.mime_types:
+            return self.mime_types[filetype]
+        return self._describe(header)[1]
+
+    def _describe(self, header):
+        """
+        libmagic description and mime type of a header, cached by its fingerprint.
+        """
+        fingerprint = hashlib.blake2b(header, digest_size=16).digest()
+        if fingerprint in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(fingerprint)
+            return self.cache[fingerprint]
+        self.cache_misses += 1
+        result = (magic.from_buffer(header), magic.from_buffer(header, mime=True))
+        self.cache[fingerprint] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _zip_type(header, fileobj=None):
+        """
+        Tells office documents apart from other zip files. Looks at the member names when the zip can be opened,
+        otherwise at the local file headers in the first few KB.
+        """
+        if fileobj is not None:
+            try:
+                with zipfile.ZipFile(fileobj) as archive:
+                    names = set(archive.namelist())
+            except zipfile.BadZipFile:
+                return FileType.ZIP
+            finally:
+                fileobj.seek(0)
+            if "[Content_Types].xml" in names:
+                if "word/document.xml" in names:
+                    return FileType.DOCX
+                if "xl/workbook.xml" in names:
+                    return FileType.XLSX
+            return FileType.ZIP
+        if b"[Content_Types].xml" in header:
+            if b"word/" in header:
+                return FileType.DOCX
+            if b"xl/" in header:
+                return FileType.XLSX
+        return FileType.ZIP
+
+class TreeWalker:
+    """
+    Walks a directory tree with os.scandir, yielding an os.DirEntry for every regular file whatever its name.
+    The entries keep the stat data from the scan so it isn't fetched again.
+    include and exclude are glob patterns matched against the file name and the path relative to the top directory,
+    exclude patterns also skip whole directories. Size limits are in bytes, modified limits are epoch seconds.
+    shard is (index, count) to only yield one of count deterministic partitions of the tree, split by a hash of each file's
+    relative path with shard_by='path', or of the top level directory it's in with shard_by='directory'.
+    Symbolic links are not followed.
+    """
+    shard_modes = ('path', 'directory')
+
+    def __init__(self, include=None, exclude=None, min_size=None, max_size=None, modified_after=None, modified_before=None, shard=None, shard_by='path'):
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        if shard is not None and not 0 <= shard[0] < shard[1]:
+            raise ValueError("shard must be (index, count) with 0 <= index < count")
+        if shard_by not in self.shard_modes:
+            raise ValueError("shard_by must be one of {}".format(", ".join(self.shard_modes)))
+        self.shard = tuple(shard) if shard is not None else None
+        self.shard_by = shard_by
+
+    @staticmethod
+    def shard_of(relative, count):
+        """
+        Partition a relative path, with '/' separators, belongs to. The same on every host and every run.
+        """
+        digest = hashlib.blake2b(relative.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % count
+
+    def _in_shard(self, entry, root, is_dir):
+        if self.shard is None:
+            return True
+        relative = os.path.relpath(entry.path, root).replace(os.sep, "/")
+        if self.shard_by == 'directory':
+            if "/" in relative: # Decided at the top level, only this shard's directories are walked at all
+                return True
+        elif is_dir:
+            return True
+        return self.shard_of(relative, self.shard[1]) == self.shard[0]
+
+    def walk(self, directory, on_error=None):
+        """
+        Yields the DirEntry of each matching file under directory.
+        on_error is called with (path, exception) for directories and files that can't be read.
+        """
+        return self._walk(directory, directory, on_error)
+
+    def count(self, directory, workers=1):
+        """
+        Counts the files walk would yield, used as the progress total. 
+        With more than one worker each top level directory is counted in its own thread.
+        """
+        files = 0
+        subdirs = []
+        for entry in self._scan(directory, None):
+            if self._is_dir(entry, directory):
+                subdirs.append(entry.path)
+            elif self._is_match(entry, directory, None):
+                files += 1
+        if workers <= 1 or len(subdirs) < 2:
+            return files + sum(self._count(subdir, directory) for subdir in subdirs)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return files + sum(pool.map(self._count, subdirs, [directory] * len(subdirs)))
+
+    def _count(self, directory, root):
+        return sum(1 for _ in self._walk(directory, root, None))
+
+    def _walk(self, directory, root, on_error):
+        stack = [directory]
+        while stack:
+            # Each directory is listed in full before its files are handed out, they get moved while the walk is still going
+            entries = self._scan(stack.pop(), on_error)
+            subdirs = []
+            for entry in entries:
+                if self._is_dir(entry, root):
+                    subdirs.append(entry.path)
+                elif self._is_match(entry, root, on_error):
+                    yield entry
+            stack.extend(reversed(subdirs))
+
+    @staticmethod
+    def _scan(directory, on_error):
+        try:
+            with os.scandir(directory) as entries:
+                return list(entries)
+        except OSError as e:
+            if on_error is not None:
+                on_error(directory, e)
+            return []
+
+    def _is_dir(self, entry, root):
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                return False
+        except OSError:
+            return False
+        return not self._matches_any(entry, root, self.exclude) and self._in_shard(entry, root, True)
+
+    @staticmethod
+    def _matches_any(entry, root, patterns):
+        if not patterns:
+            return False
+        relative = os.path.relpath(entry.path, root).replace(os.sep, "/")
+        return any(fnmatch(entry.name, pattern) or fnmatch(relative, pattern) for pattern in patterns)
+
+    def _is_match(self, entry, root, on_error):
+        try:
+            if not entry.is_file(follow_symlinks=False):
+                return False
+        except OSError:
+            return False
+        if self._matches_any(entry, root, self.exclude):
+            return False
+        if self.include and not self._matches_any(entry, root, self.include):
+            return False
+        if not self._in_shard(entry, root, False):
+            return False
+        if self.min_size is None and self.max_size is None and self.modified_after is None and self.modified_before is None:
+            return True
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            if on_error is not None:
+                on_error(entry.path, e)
+            return False
+        if self.min_size is not None and stat.st_size < self.min_size:
+            return False
+        if self.max_size is not None and stat.st_size > self.max_size:
+            return False
+        if self.modified_after is not None and stat.st_mtime < self.modified_after:
+            return False
+        if self.modified_before is not None and stat.st_mtime >= self.modified_before:
+            return False
+        return True
+
+class WorkQueue:
+    """
+    Files waiting to be searched. The tree is walked lazily and files that turn up along the way, such as extracted archive members,
+    are queued in place so every file is visited exactly once without starting the walk over.
+    Keeps the discovered and completed counts used for progress.
+    """
+    def __init__(self, walk):
+        self.walk = iter(walk)
+        self.queued = deque() # Files added while walking, handed out before walking any further
+        self.added = set() # Added files the walk may still come across, skipped when it does
+        self.discovered = 0
+        self.completed = 0
+
+    def add(self, filenames):
+        for filename in filenames:
+            if filename not in self.added:
+                self.added.add(filename)
+                self.queued.append(filename)
+                self.discovered += 1
+
+    def next_file(self):
+        """
+        Returns the next file to search, or None when there is nothing left right now.
+        """
+        if self.queued:
+            return self.queued.popleft()
+        for filename in self.walk:
+            if os.fspath(filename) in self.added:
+                self.added.discard(os.fspath(filename))
+                continue
+            self.discovered += 1
+            return filename
+        return None
+
+class ReadAhead:
+    """
+    Reads the files about to be searched in to memory on a pool of threads, so the disk or network share is kept busy
+    while the file before them is parsed. Buffers are capped by count and by total bytes and held until the file is done.
+    A file that is too large, or doesn't fit while the pool is full, isn't read ahead and the parser opens it as before.
+    Keeps the time spent waiting for a read that hadn't finished yet.
+    """
+    def __init__(self, threads=4, depth=16, max_files=32, max_bytes=256 * 1024 * 1024, max_file_size=64 * 1024 * 1024):
+        self.depth = depth # Files prepared and queued for reading ahead of the one being searched
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="read-ahead")
+        self.lock = threading.Lock()
+        self.reads = {} # filename -> future of the buffer, or None for files left to the parser
+        self.held = {} # filename -> bytes of the buffers read and not yet done with
+        self.held_bytes = 0
+        self.files = 0 # Files handed over from memory
+        self.skipped = 0 # Files left to the parser, too large or the pool was full
+        self.bytes = 0
+        self.stalls = 0 # Buffers that weren't ready when they were needed
+        self.stall_time = 0.0
+
+    def submit(self, filename, path):
+        """
+        Starts reading path in the background, filename is the name take and done are called with.
+        """
+        self.reads[filename] = self.pool.submit(self._read, filename, path)
+
+    def _read(self, filename, path):
+        with open(long_path(path), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            with self.lock:
+                if size > self.max_file_size or len(self.held) >= self.max_files or self.held_bytes + size > self.max_bytes:
+                    return None
+                self.held[filename] = size
+                self.held_bytes += size
+            try:
+                return file.read()
+            except BaseException:
+                self.done(filename)
+                raise
+
+    def take(self, filename):
+        """
+        Returns the contents of a file submitted earlier, waiting for the read if it's still going,
+        or None when the parser should open the file itself. Returns the seconds spent waiting too.
+        """
+        future = self.reads.pop(filename, None)
+        if future is None:
+            return None, 0.0
+        stalled = 0.0
+        if not future.done():
+            start = time()
+            wait([future])
+            stalled = time() - start
+            self.stalls += 1
+            self.stall_time += stalled
+        try:
+            data = future.result()
+        except OSError: # The parser opens it again and logs the failure
+            data = None
+        if data is None:
+            self.skipped += 1
+        else:
+            self.files += 1
+            self.bytes += len(data)
+        return data, stalled
+
+    def done(self, filename):
+        """
+        Gives back the room a file's buffer took up once it has been searched.
+        """
+        with self.lock:
+            self.held_bytes -= self.held.pop(filename, 0)
+
+    def stats(self):
+        return {'read_ahead_files': self.files, 'read_ahead_skipped': self.skipped, 'read_ahead_bytes': self.bytes,
+                'read_ahead_stalls': self.stalls, 'read_ahead_stall_seconds': round(self.stall_time, 3)}
+
+    def close(self):
+        for future in self.reads.values():
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        self.reads.clear()
+        self.held.clear()
+        self.held_bytes = 0
+
+class DuplicateFinder:
+    """
+    Finds files with identical content so only one copy of each has to be searched.
+    Files are grouped by size first and only the ones whose size collides are hashed, over their first partial_size bytes
+    and then, for those that still collide, in full. Keeps the bytes and parse time saved by not searching the copies.
+    """
+    def __init__(self, partial_size=64 * 1024):
+        self.partial_size = partial_size
+        self.duplicates = {} # representative path -> (size, duplicate paths)
+        self.files = 0 # Duplicates whose hits were copied from their representative
+        self.bytes_saved = 0
+        self.time_saved = 0.0
+
+    def representatives(self, entries, on_error=None):
+        """
+        Yields one entry for each distinct content, in walk order. The whole walk is read before the first one is yielded.
+        on_error is called with (path, exception) for files that can't be read, they are yielded as distinct.
+        """
+        entries = list(entries)
+        by_size = defaultdict(list)
+        for entry in entries:
+            try:
+                by_size[entry.stat(follow_symlinks=False).st_size].append(entry)
+            except OSError as e:
+                if on_error is not None:
+                    on_error(entry.path, e)
+        duplicate_paths = set()
+        for size, group in by_size.items():
+            for identical in self._identical(size, group, on_error):
+                if len(identical) > 1:
+                    paths = [entry.path for entry in identical]
+                    self.duplicates[paths[0]] = (size, paths[1:])
+                    duplicate_paths.update(paths[1:])
+        for entry in entries:
+            if entry.path not in duplicate_paths:
+                yield entry
+
+    def _identical(self, size, group, on_error):
+        """
+        Splits same sized entries in to lists of entries with the same content.
+        """
+        if len(group) == 1 or size == 0:
+            return [group]
+        identical = []
+        for partial in self._split(group, self.partial_size, on_error):
+            if len(partial) == 1 or size <= self.partial_size:
+                identical.append(partial)
+            else:
+                identical.extend(self._split(partial, None, on_error))
+        return identical
+
+    def _split(self, group, length, on_error):
+        by_hash = defaultdict(list)
+        distinct = []
+        for entry in group:
+            try:
+                by_hash[self.file_hash(entry.path, length)].append(entry)
+            except OSError as e:
+                if on_error is not None:
+                    on_error(entry.path, e)
+                distinct.append([entry])
+        return list(by_hash.values()) + distinct
+
+    @staticmethod
+    def file_hash(filename, length=None, chunk_size=1024 * 1024):
+        """
+        Hashes the first length bytes of a file, or all of it when length is None.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        with open(long_path(filename), 'rb') as file:
+            if length is not None:
+                digest.update(file.read(length))
+            else:
+                for chunk in iter(lambda: file.read(chunk_size), b""):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def take(self, path):
+        """
+        Returns (size, duplicate paths) for a representative, or None when it has no duplicates.
+        """
+        return self.duplicates.pop(path, None)
+
+    def copied(self, size, duration):
+        """
+        Counts a duplicate that was settled with its representative's hits instead of being searched.
+        """
+        self.files += 1
+        self.bytes_saved += size
+        self.time_saved += duration
+
+def long_path(path):
+    """
+    Returns the path in a form that can be opened whatever its length. On Windows paths of 260 characters or more
+    get the extended length prefix, everywhere else the path is returned as it is.
+    """
+    if os.name != 'nt' or len(path) < 260 or path.startswith("\\\\?\\"):
+        return path
+    path = os.path.abspath(path)
+    if path.startswith("\\\\"): # UNC share
+        return "\\\\?\\UNC\\" + path[2:]
+    return "\\\\?\\" + path
+
+def display_path(path):
+    """
+    Returns the path as it can be written to the results, manifest and index, which all need valid UTF-8.
+    Bytes in a file name that couldn't be decoded come out as \\xNN escapes, any other path is returned as it is.
+    """
+    try:
+        path.encode('utf-8')
+        return path
+    except UnicodeEncodeError:
+        return os.fsencode(path).decode('utf-8', 'backslashreplace')
+
+def read_keywords(keywords_file):
+    """
+    Reads a new line delimited keywords file in to a set, ignoring blank lines.
+    """
+    with open(keywords_file) as file:
+        keywords = set(line.strip() for line in file)
+    keywords.discard("")
+    return keywords
+
+def open_results_sink(results_dir, results_backend='text'):
+    """
+    Opens the results sink for a backend, 'text' for one file per keyword, 'jsonl' or 'sqlite' for a single results file.
+    """
+    if results_backend == 'jsonl':
+        return JsonlSink(os.path.join(results_dir, "results.jsonl"))
+    if results_backend == 'sqlite':
+        return SqliteSink(os.path.join(results_dir, "results.db"))
+    return KeywordFileSink(results_dir)
+
+def merge_bundles(bundle_dirs, output_dir):
+    """
+    Combines the Output directories written by the shards of a sharded scan in to output_dir, with the usual Results layout,
+    one manifest.db, one dispositions.jsonl and stats.json summed over the shards. Each shard's bundle.json, written when
+    it finishes, says which partition it searched. Bundles from different scans, the same shard twice, or bundles without a
+    bundle.json because their shard hasn't finished raise ValueError, the message listing every unfinished bundle.
+    Shards with no bundle given are merged without and listed as missing in output_dir/shards.json. Returns that summary.
+    """
+    bundles = []
+    unfinished = []
+    for bundle_dir in bundle_dirs:
+        bundle_file = os.path.join(bundle_dir, "bundle.json")
+        if not os.path.isfile(bundle_file):
+            unfinished.append(bundle_dir)
+            continue
+        with open(bundle_file, encoding='utf-8') as file:
+            bundles.append((bundle_dir, json.load(file)))
+    if unfinished:
+        raise ValueError("these shards haven't finished, they have no bundle.json: {}".format(", ".join(unfinished)))
+    if not bundles:
+        raise ValueError("no bundles to merge")
+    first = bundles[0][1]
+    seen = set()
+    for bundle_dir, bundle in bundles:
+        for key in ('shards', 'shard_by', 'search_dir', 'keyword_version', 'results_backend'):
+            if bundle[key] != first[key]:
+                raise ValueError("{} is from a different scan, its {} is {!r} not {!r}".format(bundle_dir, key, bundle[key], first[key]))
+        if bundle['shard'] in seen:
+            raise ValueError("shard {} is in more than one bundle".format(bundle['shard']))
+        seen.add(bundle['shard'])
+    results_dir = os.path.join(output_dir, "Results")
+    if os.path.isdir(results_dir) and os.listdir(results_dir):
+        raise ValueError("{} isn't empty, merging again would duplicate the results".format(results_dir))
+    os.makedirs(results_dir, exist_ok=True)
+
+    backend = first['results_backend']
+    manifest = None
+    file_type_stats = {'total':0}
+    with ExitStack() as stack:
+        dispositions = None
+        for bundle_dir, bundle in sorted(bundles, key=lambda item: item[1]['shard']):
+            bundle_results = os.path.join(bundle_dir, "Results")
+            if backend == 'sqlite':
+                results = SqliteSink(os.path.join(results_dir, "results.db"))
+                try:
+                    results.connection.execute("ATTACH DATABASE ? AS bundle", (os.path.join(bundle_results, "results.db"),))
+                    results.connection.execute("INSERT INTO results SELECT keyword, path, location, context FROM bundle.results")
+                    results.connection.commit()
+                    results.connection.execute("DETACH DATABASE bundle")
+                finally:
+                    results.close()
+            else: # One file per keyword, or a single jsonl file, records from each shard are appended to the file of the same name
+                for name in sorted(os.listdir(bundle_results)):
+                    with open(os.path.join(bundle_results, name), 'rb') as source, open(os.path.join(results_dir, name), 'ab') as destination:
+                        copyfileobj(source, destination)
+            if os.path.isfile(os.path.join(bundle_dir, "manifest.db")):
+                if manifest is None:
+                    manifest = ScanManifest(os.path.join(output_dir, "manifest.db"))
+                manifest.connection.execute("ATTACH DATABASE ? AS bundle", (os.path.join(bundle_dir, "manifest.db"),))
+                manifest.connection.execute("INSERT OR REPLACE INTO files SELECT * FROM bundle.files")
+                manifest.connection.execute("INSERT OR IGNORE INTO keyword_sets SELECT * FROM bundle.keyword_sets")
+                manifest.connection.commit()
+                manifest.connection.execute("DETACH DATABASE bundle")
+            if os.path.isfile(os.path.join(bundle_dir, "dispositions.jsonl")):
+                if dispositions is None:
+                    dispositions = stack.enter_context(open(os.path.join(output_dir, "dispositions.jsonl"), 'ab'))
+                with open(os.path.join(bundle_dir, "dispositions.jsonl"), 'rb') as source:
+                    copyfileobj(source, dispositions)
+            for mime, count in (bundle['stats'] or {}).items():
+                file_type_stats[mime] = file_type_stats.get(mime, 0) + count
+    if manifest is not None:
+        manifest.close()
+
+    summary = {key: first[key] for key in ('shards', 'shard_by', 'search_dir', 'keyword_version', 'results_backend')}
+    summary['merged'] = sorted(seen)
+    summary['missing'] = [shard for shard in range(first['shards']) if shard not in seen]
+    for key in ('discovered', 'completed', 'skipped'):
+        summary[key] = sum(bundle[key] for _, bundle in bundles)
+    summary['prefilter_skipped'] = {}
+    for _, bundle in bundles:
+        for filetype, count in bundle.get('prefilter_skipped', {}).items():
+            summary['prefilter_skipped'][filetype] = summary['prefilter_skipped'].get(filetype, 0) + count
+    summary['bundles'] = [dict(bundle, bundle_dir=bundle_dir) for bundle_dir, bundle in bundles]
+    if all(bundle['stats'] is not None for _, bundle in bundles):
+        with open(os.path.join(output_dir, "stats.json"), 'w') as file:
+            json.dump(file_type_stats, file, indent=4)
+    with open(os.path.join(output_dir, "shards.json"), 'w', encoding='utf-8') as file:
+        json.dump(summary, file, indent=4, ensure_ascii=False)
+    return summary
 
 class FileSearcher:
     """
     Provides methods for organizing and searching through files. 
     """
-    def __init__(self, working_dir, original_dir, keywords_file, estimated_files=None):
+    results_backends = ('text', 'jsonl', 'sqlite')
+    parsers = { # Search method for each supported file type
+        FileType.TEXT: '_search_plaintext',
+        FileType.XLSX: '_search_excel',
+        FileType.XLS: '_search_excel_old_format',
+        FileType.DOCX: '_search_word_docx',
+        FileType.PDF: '_search_pdf',
+    }
+
+    def __init__(self, working_dir, original_dir, keywords_file, estimated_files=None, results_backend='text', log_verbosity='info', manifest=False, manifest_hash=False, stream_archives=True, max_archive_depth=3, max_member_size=512 * 1024 * 1024, walker=None, index=False, extract_cache=False, pdf_backend='pypdf2', dedup=False, metrics=False, read_only=False, read_ahead=False, prefilter=False):
         #Provided to the class
         self.working_dir = working_dir # Base directory we are working from
         self.original_dir = original_dir # Directory containing the files we intend to work with
         self.keywords_file = keywords_file # File containing the keywords which will be searched for
-        self.keywords = set()
-        with open(self.keywords_file) as file:
-            for line in file:
-                self.keywords.add(line.strip())
+        self.keywords = read_keywords(self.keywords_file)
+        self.matcher = KeywordMatcher(self.keywords) # Compiled once, shared by all of the search methods
         self.system_encoding = getfilesystemencoding()
         self.estimated_files = estimated_files # Used for more accurately displaying progress with TQDM
+        self.walker = walker or TreeWalker() # Decides which files are searched, every regular file by default
+        if self.walker.shard is not None and not stream_archives:
+            raise ValueError("sharding needs stream_archives, archives extracted by one shard would be walked by the others")
+        if results_backend not in self.results_backends:
+            raise ValueError("results_backend must be one of {}".format(", ".join(self.results_backends)))
+        self.results_backend = results_backend # 'text' for one file per keyword, 'jsonl' or 'sqlite' for a single results file
+        self.results = None # Results sink, opened by create_dirs
+        self.log_verbosity = log_verbosity # 'error', 'info' or 'debug'. Per file success records are only written with 'debug'
+        self.log = None # RunLog, opened by create_dirs
+        self.use_manifest = manifest # Keep Output/manifest.db so unchanged files are skipped on the next run
+        self.manifest_hash = manifest_hash # Also compare content hashes, reads every file an extra time
+        self.manifest = None # ScanManifest, opened by create_dirs
+        self._matchers = {} # Matchers for subsets of the keywords, used when a file only needs the new keywords
+        self._manifest_pending = {} # filename -> (size, mtime, hash, keywords) for files being searched
+        self.flush_interval = 30 # Seconds between flushing the results and manifest during process_directory
+        self.stream_archives = stream_archives # Search archives member by member instead of extracting them in to the search directory
+        self.max_archive_depth = max_archive_depth # How many levels of archives inside archives are opened
+        self.max_member_size = max_member_size # Largest archive member read in to memory for the parsers that need to seek
+        self.archive_separator = "!" # Results for archive members use 'archive!member' as the path
+        self.classifier = FileClassifier()
+        self.plaintext_chunk_size = 4 * 1024 * 1024 # Bytes of a text file matched at a time
+        self.plaintext_overlap = 64 * 1024 # Bytes shared between neighbouring windows so hits on the boundary aren't missed
+        self.max_line_context = 4096 # Bytes of the line either side of a hit written to the results
+        self.use_index = index # Keep the extracted text in Output/index.db so new keyword lists can be answered with query_index
+        self.index = None # TextIndex, opened by create_dirs
+        self.index_block_size = 256 * 1024 # Characters of plain text stored per index segment
+        self.use_extract_cache = extract_cache # Cache the text extracted from PDF, Excel and Word files by content hash
+        self.extract_cache_dir = None # Defaults to Output/Cache, best kept on a local disk
+        self.extract_cache_size = 1024 * 1024 * 1024 # Bytes of compressed text kept before the least recently used entries are evicted
+        self.extract_cache = None # ExtractCache, opened by create_dirs
+        if pdf_backend not in PdfExtractor.backends:
+            raise ValueError("pdf_backend must be one of {}".format(", ".join(PdfExtractor.backends)))
+        self.pdf_backend = pdf_backend # 'pypdf2', 'pdftotext' or 'auto' for pdftotext when it is installed
+        self.pdf_timeout = 600 # Seconds a PDF gets before its extraction process is killed
+        self.pdf_page_timeout = 20 # Seconds allowed between pages
+        self.pdf_memory_limit = 2 * 1024 * 1024 * 1024 # Bytes the extraction process can allocate, POSIX only
+        self._pdf_extractor = None # PdfExtractor, started on the first PDF
+        self.excel_backend = 'openpyxl' # 'xml' reads xlsx cells straight from the sheet XML, faster but dates stay as serial numbers
+        if dedup and index:
+            raise ValueError("dedup can't be used with index, duplicates aren't searched so they have no text to index")
+        self.dedup = dedup # Search one copy of each distinct file and give its hits to the identical copies
+        self.duplicates = None # DuplicateFinder, set up by process_directory
+        self._duplicate_pending = {} # filename -> (size, duplicate paths, keywords) for representatives being searched
+        self._duplicate_hits = {} # filename -> (size, duplicate paths, keywords, hits, duration) for searched representatives
+        self.use_metrics = metrics # Time every stage of process_directory, see RunMetrics
+        self.metrics_file = None # Defaults to Output/metrics.json, a name ending in '.prom' gets the Prometheus text format
+        self.metrics_interval = 60 # Seconds between metrics snapshots
+        self.slowest_files = 20 # Slowest files kept in the metrics with their stage breakdown
+        self.metrics = None # RunMetrics, opened by create_dirs
+        self._timings = None # {stage: seconds} for the file being searched, only while metrics are on
+        self._timed_type = None # Detected type of the file being searched
+        self._file_timings = {} # filename -> (file type, {stage: seconds}) for files in flight
+        if read_only and not stream_archives:
+            raise ValueError("read_only needs stream_archives, extracting archives writes to the search directory")
+        self.read_only = read_only # Only read the search directory, dispositions go to Output/dispositions.jsonl instead of moving files
+        self.report = None # DispositionReport, opened by create_dirs in read only mode
+        self._collect_stats = False # Set by process_directory(stats=True)
+        self._file_mime = None # Mime type of the file being searched while collecting stats
+        self._file_mimes = {} # filename -> mime type for searched files waiting to be counted
+        self._group = False # Set by process_directory(group=True)
+        self.use_read_ahead = read_ahead # Read upcoming files in to memory on background threads while the current one is parsed
+        self.read_ahead_threads = 4 # Files read at once, more helps on network shares
+        self.read_ahead_depth = 16 # Files prepared and read ahead of the one being searched
+        self.read_ahead_files = 32 # Most buffers held at once, including files with the workers
+        self.read_ahead_bytes = 256 * 1024 * 1024 # Most bytes held at once
+        self.read_ahead_file_size = 64 * 1024 * 1024 # Larger files are opened by the parser as usual
+        self.read_ahead = None # ReadAhead, set up by process_directory
+        self._ahead = deque() # (item, held for duplicates) prepared ahead of the file being searched
+        if prefilter and index:
+            raise ValueError("prefilter can't be used with index, the index needs the text of every file")
+        self.prefilter = prefilter # Check the raw XML of Word and Excel files for the keywords before parsing them
+        self.prefilter_skipped = {} # file type -> parses skipped because the prefilter ruled the file out
+        self._prefiltered = {} # The same for the file being searched, handed back by the workers
 
     def create_dirs(self):
         """
@@ -46,17 +1843,32 @@ class FileSearcher:
         self.results_dir = os.path.join(self.output_dir, "Results") # Directory to place results
         self.error_dir = os.path.join(self.output_dir, "Error_Files")
         self.unsupported_dir = os.path.join(self.output_dir, "Unsupported_Files")
-        self.log_file = os.path.join(self.output_dir, "log.txt") # Used for error logging
+        self.log_file = os.path.join(self.output_dir, "log.jsonl") # Structured run log
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
-        if not os.path.exists(self.processed_dir):
-            os.mkdir(self.processed_dir) 
         if not os.path.exists(self.results_dir):
             os.mkdir(self.results_dir) 
-        if not os.path.exists(self.error_dir):
-            os.mkdir(self.error_dir)
-        if not os.path.exists(self.unsupported_dir):
-            os.mkdir(self.unsupported_dir)
+        if not self.read_only: # Nothing gets moved in read only mode
+            if not os.path.exists(self.processed_dir):
+                os.mkdir(self.processed_dir) 
+            if not os.path.exists(self.error_dir):
+                os.mkdir(self.error_dir)
+            if not os.path.exists(self.unsupported_dir):
+                os.mkdir(self.unsupported_dir)
+        elif self.report is None:
+            self.report = DispositionReport(os.path.join(self.output_dir, "dispositions.jsonl"))
+        if self.log is None:
+            self.log = RunLog(self.log_file, verbosity=self.log_verbosity)
+        if self.results is None:
+            self.results = self.open_results_sink()
+        if self.use_manifest and self.manifest is None:
+            self.manifest = ScanManifest(os.path.join(self.output_dir, "manifest.db"), use_hash=self.manifest_hash)
+        if self.use_index and self.index is None:
+            self.index = TextIndex(os.path.join(self.output_dir, "index.db"))
+        if self.use_extract_cache and self.extract_cache is None:
+            self.extract_cache = ExtractCache(self.extract_cache_dir or os.path.join(self.output_dir, "Cache"), self.extract_cache_size)
+        if self.use_metrics and self.metrics is None:
+            self.metrics = RunMetrics(self.metrics_file or os.path.join(self.output_dir, "metrics.json"), self.slowest_files, self.metrics_interval)
         
         # ##  For testing ##
         # self.results_dir = os.path.join(self.working_dir, "temp_Results")
@@ -65,6 +1877,78 @@ class FileSearcher:
         # self.error_dir = os.path.join(self.working_dir, "temp_Error_Files")
         # ##              ##      
 
+    def open_results_sink(self):
+        """
+        Opens the results sink for the configured backend.
+        """
+        return open_results_sink(self.results_dir, self.results_backend)
+
+    def close(self):
+        """
+        Flushes and closes anything left open by the run. 
+        """
+        if self.results is not None:
+            self.results.close()
+            self.results = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.report is not None:
+            self.report.close()
+            self.report = None
+        if self.extract_cache is not None:
+            self.extract_cache.maybe_trim()
+            self.extract_cache = None
+        if self._pdf_extractor is not None:
+            self._pdf_extractor.stop()
+            self._pdf_extractor = None
+        if self.metrics is not None:
+            self.metrics.write()
+            self.metrics = None
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def flush(self):
+        """
+        Flushes the results and index, then the manifest, disposition report and log.
+        Results go first so the manifest and report never claim a file whose hits aren't on disk.
+        """
+        self.results.flush()
+        if self.index is not None:
+            self.index.flush()
+        if self.manifest is not None:
+            self.manifest.flush()
+        if self.report is not None:
+            self.report.flush()
+        if self.extract_cache is not None:
+            self.extract_cache.maybe_trim()
+        if self.metrics is not None:
+            self.metrics.maybe_write()
+        self.log.flush()
+
+    def _record_hits(self, filename, text, location=None):
+        """
+        Runs the keyword matcher over a piece of text and sends every hit to the results sink.
+        The text is also added to the index when one is being built.
+        """
+        started = time() if self._timings is not None else None
+        for keyword in self.matcher.search(text):
+            self.results.write(keyword, filename, text, location)
+        if started is not None:
+            self._add_timing('match', started)
+        if self.index is not None:
+            self.index.add(filename, location, text)
+
+    def _add_timing(self, stage, started):
+        """
+        Adds the time since started to a stage of the file being searched, only called while metrics are being collected.
+        """
+        self._timings[stage] = self._timings.get(stage, 0.0) + time() - started
+
     def rename_file(self, filename):
         """
         Renames file using 'safe' characters.
@@ -89,9 +1973,7 @@ class FileSearcher:
                 filename = "\\\\?\\" + filename
             try:
                 os.rename(filename, new_filename)
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Success]{}".format(self.rename_file.__name__,filename))
-                    log_file.write('\n')
+                self.log.success(self.rename_file.__name__, filename)
                 return new_filename
             except FileExistsError as e:
                 # for some reason, some files get copied and look like they don't exist in the file explorer. Look at them with 'll' they show. 
@@ -99,19 +1981,27 @@ class FileSearcher:
                 os.remove(filename)
                 return new_filename 
             except Exception as e:
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Failed]{} --- {}".format(self.rename_file.__name__,filename, str(e)))
-                    log_file.write('\n')
+                self.log.failure(self.rename_file.__name__, filename, e)
                 return False # Probably should so somthing different here? Not sure the best solution. 
         else:
             return False
 
+    def _refuse_in_read_only(self, stage, path):
+        """
+        Logs and returns True when a method that changes the search directory is called in read only mode.
+        """
+        if self.read_only:
+            self.log.failure(stage, path, "Skipped, the searcher is in read only mode.")
+        return self.read_only
+
     def group_by_extension(self):
         """
         Identifies extensions for all files in directories and sub-directories, \n
         groups similar file types together using the extension as the new directory name.\n
         Files are moved from the original directory to the new directory.
         """
+        if self._refuse_in_read_only(self.group_by_extension.__name__, self.original_dir):
+            return
         destination_dir = os.path.join(self.output_dir, "Grouped")
         
         if not os.path.exists(destination_dir):
@@ -140,17 +2030,15 @@ class FileSearcher:
                     new_file_basename = file_basename_no_extension + "_" + str(now) + "." + extension
                     new_filepath = os.path.join(destination_dir, extension_dir, new_file_basename)
                 move(og_filepath, new_filepath)
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Success]{}".format(self.group_by_extension.__name__,og_filepath))
-                    log_file.write('\n')
+                self.log.success(self.group_by_extension.__name__, og_filepath)
             except Exception as e:
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Failed]{}".format(self.group_by_extension.__name__,str(e)))
-                    log_file.write('\n')
+                self.log.failure(self.group_by_extension.__name__, og_filepath, e)
 
-    def organize(self, search_dir, filename, error=False, supported=True):
+    def organize(self, search_dir, filename, error=False, supported=True, group=None):
         """
         Method to move files to a new directory while retaining any sub directories.
+        group is an extra directory level put in front of the sub directories, such as the file's extension.
+        Returns the new file path, or False if the move failed.
         """
         if error is True:
             dest_dir = self.error_dir
@@ -158,12 +2046,13 @@ class FileSearcher:
             dest_dir = self.processed_dir
         if supported is False:
             dest_dir = self.unsupported_dir
+        if group:
+            dest_dir = os.path.join(dest_dir, group)
         # Building out the directory structure. The goal is to perserve the relevant directories and save into a new directory. 
         og_dir = os.path.split(filename)[0] # Original file directory
-        if og_dir == search_dir: # Condition for when we are searching the base directory
-            og_dir_base = og_dir.replace(search_dir, "") # Directory path excluding the path we started from
-        else: # Condition for when we are searching sub directories
-            og_dir_base = og_dir.replace(search_dir + "\\", "") # Directory path excluding the path we started from
+        og_dir_base = os.path.relpath(og_dir, search_dir) # Directory path excluding the path we started from
+        if og_dir_base == os.curdir: # Condition for when we are searching the base directory
+            og_dir_base = ""
         og_file_basename = os.path.split(filename)[1] # Original file name
         partial_new_filepath = os.path.join(og_dir_base, og_file_basename) # New file path without the working directory
         full_new_dirpath = os.path.join(dest_dir, og_dir_base) # Combining the destination directory and the relevant directory structure.
@@ -174,22 +2063,32 @@ class FileSearcher:
             os.makedirs(full_new_dirpath)
         try:
             move(filename, new_file)
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{} -> {}".format(self.organize.__name__,filename, new_file))
-                log_file.write('\n')
-            return True
+            self.log.success(self.organize.__name__, filename, destination=new_file)
+            return new_file
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self.organize.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self.organize.__name__, filename, e)
             return False
 
     def generate_filenames(self, directory):
         """
         Simple function to generate filenames based on the files within the provided directory
         """
-        filename_gen = glob.iglob(directory + '/**/*.*', recursive=True) #Generator for the filenames, recursively searches for all files in the directory.
-        return filename_gen
+        return (entry.path for entry in self.generate_entries(directory))
+
+    def generate_entries(self, directory):
+        """
+        Generates an os.DirEntry for each file the walker accepts, the entries carry the stat data from the directory scan.
+        """
+        return self.walker.walk(directory, on_error=lambda path, e: self.log.failure(self.generate_entries.__name__, path, e))
+
+    def count_files(self, directory, workers=1):
+        """
+        Counts the files that would be searched without opening any of them. Top level directories are counted in parallel with more than one worker.
+        """
+        started = time()
+        total = self.walker.count(directory, workers=workers)
+        self.log.info("counted", self.count_files.__name__, directory, duration=time() - started, files=total)
+        return total
 
     def get_file_magic(self, filename):
         """
@@ -197,14 +2096,23 @@ class FileSearcher:
         """
         try:
             filetype = magic.from_file(filename)
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self.get_file_magic.__name__,filename))
-                log_file.write('\n')
+            self.log.success(self.get_file_magic.__name__, filename)
+            return filetype
+        except Exception as e:
+            self.log.failure(self.get_file_magic.__name__, filename, e)
+            return False
+
+    def classify_file(self, filename):
+        """
+        Detects the FileType of a file on disk from its header. Returns False if the file can't be read.
+        """
+        try:
+            with open(filename, 'rb') as file:
+                filetype = self.classifier.classify(file.read(self.classifier.header_size), filename, file)
+            self.log.success(self.classify_file.__name__, filename, filetype=filetype.value)
             return filetype
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failed]{} --- {}".format(self.get_file_magic.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self.classify_file.__name__, filename, e)
             return False
 
     def get_filetype_stats(self, directory):
@@ -212,67 +2120,66 @@ class FileSearcher:
         Provides statistics for the total amount of files and each detected mimetype.
         Outputs results to a json file. 
         """
-        file_type_stats = {'total':0} # Dictionary for storing stats
+        file_type_stats = {'total':0} # Dictionary for storing stats, process_directory(stats=True) builds the same from its own pass
         filename_gen = self.generate_filenames(directory) # Files to process
         for filename in tqdm(filename_gen, total=self.estimated_files):
             try:
                 # mimetype = magic.from_file(filename, mime=True).split("/")[0] # Detects mime type rather then file type, ommits data after the '/' to keep it more generic
-                mimetype = magic.from_file(filename, mime=True) # Detects mime type rather then file type
+                with open(filename, 'rb') as file:
+                    mimetype = self.classifier.mime(file.read(self.classifier.header_size)) # Detects mime type rather then file type
                 file_type_stats['total'] += 1
                 if mimetype not in file_type_stats:
                     file_type_stats[mimetype] = 1
                 else:
                     file_type_stats[mimetype] += 1
             except Exception as e:
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Failed]{} --- {}".format(self.get_filetype_stats.__name__,filename, str(e)))
-                    log_file.write('\n')
-        
+                self.log.failure(self.get_filetype_stats.__name__, filename, e)
+        return self.write_filetype_stats(file_type_stats)
+
+    def write_filetype_stats(self, file_type_stats):
+        """
+        Writes the file type statistics to Output/stats.json. Returns them, or False if they couldn't be written.
+        """
         try:
             stats_file = os.path.join(self.output_dir, "stats.json")
             with open(stats_file, 'w') as file:
                 json.dump(file_type_stats, file, indent=4) # Output in a pretty print format
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]".format(self.get_filetype_stats.__name__))
-                log_file.write('\n')
+            self.log.success(self.write_filetype_stats.__name__, stats_file, level='info')
             return file_type_stats
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failed]{}".format(self.get_filetype_stats.__name__, str(e)))
-                log_file.write('\n')
+            self.log.failure(self.write_filetype_stats.__name__, error=e)
             return False
         
     def uncompress_tar(self, filename, dest_dir):
         """
         Uncompresses the file and saves to the destination directory
+        Returns the list of files extracted, or False if the file couldn't be uncompressed.
         """
         try:
             tar = tarfile.open(filename)
             members = tar.getmembers() # Contents of the compressed file
             tar.extractall(members=tqdm(members, desc=f"Uncompressing {filename}"), path=dest_dir) # Uncompress and use a progress bar
             tar.close()
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self.uncompress_tar.__name__,filename))
-                log_file.write('\n')
-            return True
+            self.log.success(self.uncompress_tar.__name__, filename, level='info')
+            return [os.path.join(dest_dir, member.name) for member in members if member.isfile()]
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failed]{} --- {}".format(self.uncompress_tar.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self.uncompress_tar.__name__, filename, e)
             return False
 
     def uncompress_tar_flevel(self, directory):
         """
         Uncompresses all files in the first level of the directory and saves to the destination directory
         """
+        if self._refuse_in_read_only(self.uncompress_tar_flevel.__name__, directory):
+            return
         first_level_files = os.listdir(directory)
         for f in tqdm(first_level_files, desc="Checking for Compressed Files"):
             filename = os.path.join(directory, f)
-            filetype = self.get_file_magic(filename)
+            filetype = self.classify_file(filename)
             if filetype:
-                if ".tar.gz" in filename.lower() or "gzip compressed data" in filetype.lower(): # Experienced some issues with python-magic classifying gzip files, using the less reliable file name as well. 
+                if filetype is FileType.GZIP:
                     print(f"\nInspecting compressed file --- {filename}\n")
-                    if self.uncompress_tar(filename, directory): # Uncompress file and save in the same directory
+                    if self.uncompress_tar(filename, directory) is not False: # Uncompress file and save in the same directory
                         self.organize(directory, filename)
                     else:
                         self.organize(directory, filename, error=True)
@@ -283,6 +2190,8 @@ class FileSearcher:
         Will continue to loop over the directories until no empties are found. 
         This allows for multiple levels of empty and nested directories to be deleted. 
         """
+        if self._refuse_in_read_only(self.cleanup_directories.__name__, directory):
+            return False
         while True:
             # Build set of empty directories
             empty_dirs = set()
@@ -292,9 +2201,7 @@ class FileSearcher:
             
             # Exit when there are no empty directories
             if not empty_dirs:
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Success]{}".format(self.cleanup_directories.__name__,directory))
-                    log_file.write('\n')
+                self.log.success(self.cleanup_directories.__name__, directory, level='info')
                 return True
 
             # Try and remove directories, exit if there are problems to avoid going into a loop
@@ -302,172 +2209,693 @@ class FileSearcher:
                 for d in empty_dirs:
                     try:
                         os.rmdir(d)
-                        with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                            log_file.write("[{} Success]{}".format(self.cleanup_directories.__name__,directory))
-                            log_file.write('\n')
+                        self.log.success(self.cleanup_directories.__name__, directory, level='info')
                         return True
                     except Exception as e:
-                        with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                            log_file.write("[{} Failed]{} --- {}".format(self.cleanup_directories.__name__,directory, str(e)))
-                            log_file.write('\n')
+                        self.log.failure(self.cleanup_directories.__name__, directory, e)
                         return False
     
     ########### Search methods, should probably be moved to their own class. 
-    def _search_plaintext(self, filename):
+    def _search_plaintext(self, filename, fileobj=None):
         """
         Searches a provided text file using the keywords list included in the class. 
         Writes findings to a file, using the keyword as the filename. 
+        fileobj is a binary stream to read instead of opening filename, such as an archive member.
+        The file is scanned as bytes in fixed size windows, memory mapped when it is on disk, and only lines with a hit get decoded.
+        Memory use is the same however large the file or long its lines, and a stray invalid byte no longer fails the file.
+        Files with a UTF-16/32 byte order mark, or keyword lists that can't be matched as bytes, are decoded line by line instead.
         """
+        start = time()
         try:
-            with open(filename, encoding='utf-8') as file: 
-                for line in file:
-                    for keyword in self.keywords:
-                        if re.search(keyword, line, re.IGNORECASE):
-                            keyword_result_file = os.path.join(self.results_dir, keyword + ".txt")
-                            with open(keyword_result_file, 'a') as krs:
-                                # file_basename = os.path.split(filename)[1] #Only the filename
-                                result = filename + "---" + line
-                                krs.write(result)
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self._search_plaintext.__name__,filename))
-                log_file.write('\n')
+            with open(filename, 'rb') if fileobj is None else nullcontext(fileobj) as file:
+                encoding = self._bom_encoding(self._peek(file, 4))
+                if self.index is not None: # Every line has to be decoded for the index anyway
+                    self._index_lines(filename, file, encoding)
+                elif encoding or not self.matcher.bytes_capable:
+                    self._search_decoded_lines(filename, file, encoding or 'utf-8')
+                else:
+                    self._scan_bytes(filename, file)
+            self.log.success(self._search_plaintext.__name__, filename, duration=time() - start)
             return True
 
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self._search_plaintext.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self._search_plaintext.__name__, filename, e, duration=time() - start)
             return False
-    
-    def _search_excel(self, filename):
+
+    @staticmethod
+    def _bom_encoding(header):
+        for bom, encoding in ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+            if header.startswith(bom):
+                return encoding
+        return None
+
+    def _search_decoded_lines(self, filename, file, encoding):
+        """
+        Decodes the stream and matches it line by line, undecodable bytes are replaced rather than failing the file.
+        Each keyword is reported once per line, with the line or the piece of a long line it was found in.
+        """
+        current_line, keywords_on_line = None, set()
+        for line_number, line in self._decoded_lines(file, encoding):
+            if line_number != current_line:
+                current_line, keywords_on_line = line_number, set()
+            started = time() if self._timings is not None else None
+            for keyword in self.matcher.search(line) - keywords_on_line:
+                keywords_on_line.add(keyword)
+                self.results.write(keyword, filename, line, "line {}".format(line_number))
+            if started is not None:
+                self._add_timing('match', started)
+
+    def _decoded_lines(self, file, encoding):
+        """
+        Generator of (line number, text) decoding the stream plaintext_chunk_size bytes at a time, with the same line endings
+        as a file opened in text mode. A line longer than a window comes out as pieces of the window size that overlap by
+        _plaintext_overlap, all with its line number, so memory stays bounded however long the line.
+        """
+        window_size, overlap = self.plaintext_chunk_size, self._plaintext_overlap()
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors='replace'), translate=True)
+        line_number = 1
+        pending = "" # The start of a line that hasn't ended yet
+        while True:
+            data = file.read(window_size)
+            lines = (pending + decoder.decode(data, final=not data)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line_number, line + "\n"
+                line_number += 1
+            if not data:
+                if pending:
+                    yield line_number, pending
+                return
+            while len(pending) > window_size + overlap:
+                yield line_number, pending[:window_size + overlap]
+                pending = pending[window_size:]
+
+    def _index_lines(self, filename, file, encoding):
+        """
+        Matches the file line by line while adding it to the index in blocks of about index_block_size characters.
+        """
+        lines = self._decoded_lines(file, encoding) if encoding else enumerate((self._decode_line(line) for line in file), start=1)
+        block, block_start, block_size = [], 1, 0
+        current_line, keywords_on_line = None, set()
+        for line_number, line in lines:
+            line = line.rstrip("\r\n")
+            if line_number != current_line:
+                current_line, keywords_on_line = line_number, set()
+            elif block: # The next piece of a long line, a block of its own keeps the line numbers in the index right
+                self.index.add(filename, "line {}".format(block_start), "\n".join(block), block_start)
+                block, block_size = [], 0
+            for keyword in self.matcher.search(line) - keywords_on_line:
+                keywords_on_line.add(keyword)
+                self.results.write(keyword, filename, line, "line {}".format(line_number))
+            if not block:
+                block_start = line_number
+            block.append(line)
+            block_size += len(line) + 1
+            if block_size >= self.index_block_size:
+                self.index.add(filename, "line {}".format(block_start), "\n".join(block), block_start)
+                block, block_size = [], 0
+        if block:
+            self.index.add(filename, "line {}".format(block_start), "\n".join(block), block_start)
+
+    def _byte_windows(self, file):
+        """
+        Generator of (offset, window, last) covering the file in windows of plaintext_chunk_size plus the overlap with the next window.
+        Files on disk are memory mapped, anything else is read as a stream.
+        """
+        chunk_size, overlap = self.plaintext_chunk_size, self._plaintext_overlap()
+        if type(file) is io.BufferedReader and isinstance(file.raw, io.FileIO): # Only a real file, compressed streams also answer fileno()
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                offset = 0
+                while True:
+                    end = min(size, offset + chunk_size + overlap)
+                    yield offset, mapped[offset:end], end >= size
+                    if end >= size:
+                        return
+                    offset = end - overlap
+        offset = 0
+        window = file.read(chunk_size + overlap)
+        while window:
+            following = file.read(chunk_size)
+            yield offset, window, not following
+            offset += len(window) - overlap
+            window = window[-overlap:] + following if following else b""
+
+    def _plaintext_overlap(self):
+        # Each window hands over to the next half way through the overlap, leaving room for the match and its context on both sides
+        return max(self.plaintext_overlap, 2 * (self.max_line_context + self.matcher.max_literal_bytes) + 2)
+
+    def _scan_bytes(self, filename, file):
+        """
+        Runs the bytes matcher over the file window by window. Each hit is reported once per line and keyword with the
+        decoded line around it, up to max_line_context bytes either side of the hit.
+        """
+        half_overlap = self._plaintext_overlap() // 2
+        handled_up_to = 0 # File offset up to which hits have been handled, the next window carries on from here
+        newlines = 0 # Newlines in the file before handled_up_to
+        current_line = None
+        keywords_on_line = set()
+        for offset, window, last in self._byte_windows(file):
+            lower = handled_up_to - offset
+            upper = len(window) if last else len(window) - half_overlap
+            position = lower
+            started = time() if self._timings is not None else None
+            hits = sorted(self.matcher.search_bytes(window))
+            if started is not None:
+                self._add_timing('match', started)
+            for hit_start, _, keyword in hits:
+                if hit_start < lower or hit_start >= upper:
+                    continue # Belongs to the neighbouring window
+                newlines += window.count(b"\n", position, hit_start)
+                position = hit_start
+                if newlines != current_line:
+                    current_line = newlines
+                    keywords_on_line = set()
+                if keyword in keywords_on_line:
+                    continue
+                keywords_on_line.add(keyword)
+                self.results.write(keyword, filename, self._line_context(window, hit_start), "line {}".format(newlines + 1))
+            newlines += window.count(b"\n", position, upper)
+            handled_up_to = offset + upper
+
+    def _line_context(self, window, hit_start):
+        """
+        Decodes the line around a hit, trying UTF-8 first and falling back to Windows-1252.
+        """
+        earliest = max(0, hit_start - self.max_line_context)
+        line_start = window.rfind(b"\n", earliest, hit_start)
+        line_start = earliest if line_start == -1 else line_start + 1
+        line_end = window.find(b"\n", hit_start, hit_start + self.max_line_context)
+        if line_end == -1:
+            line_end = min(len(window), hit_start + self.max_line_context)
+        return self._decode_line(window[line_start:line_end].rstrip(b"\r"))
+
+    @staticmethod
+    def _decode_line(line):
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            return line.decode('cp1252', errors='replace')
+
+    def _search_excel(self, filename, fileobj=None):
         """
         Searches a modern excel file using the keywords list included in the class. 
         Writes findings to a file, using the keyword as the filename. 
         openpyxl is a Python library to read/write Excel 2010 xlsx/xlsm/xltx/xltm files.
         """
+        start = time()
         try:
-            wb = openpyxl.load_workbook(filename)
-            sheets = wb.sheetnames
-            
-            for sheet in sheets:
-                ws = wb[sheet]
-                for row_cells in ws.iter_rows(max_row=10000): #setting a max row in case the file, some excel files can have seemingly endless rows even though they are blank
-                    for cell in row_cells:
-                        if cell.value:
-                            for keyword in self.keywords:
-                                if re.search(keyword, str(cell.value), re.IGNORECASE):
-                                    keyword_result_file = os.path.join(self.results_dir, keyword + ".txt")
-                                    with open(keyword_result_file, 'a') as krs:
-                                        # file_basename = os.path.split(filename)[1] #Only the filename
-                                        result = filename + "---" + cell.value
-                                        krs.write(result)
-                                        krs.write("\n")
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self._search_excel.__name__,filename))
-                log_file.write('\n')
+            for location, text in self._extracted_text(filename, fileobj, self._extract_excel, self.excel_backend):
+                self._record_hits(filename, text, location)
+            self.log.success(self._search_excel.__name__, filename, duration=time() - start)
             return True
 
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self._search_excel.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self._search_excel.__name__, filename, e, duration=time() - start)
+            return False
+
+    def _extract_excel(self, filename, fileobj=None):
+        """
+        Generator of (location, text) for the cells of a modern excel file.
+        Rows are streamed in read only mode so memory use doesn't grow with the size of the sheet, and every row is covered.
+        """
+        if self.excel_backend == 'xml':
+            yield from self._extract_excel_xml(filename, fileobj)
+            return
+        wb = openpyxl.load_workbook(filename if fileobj is None else fileobj, read_only=True)
+        try:
+            for ws in wb.worksheets:
+                if not hasattr(ws, 'reset_dimensions'): # Chartsheets
+                    continue
+                ws.reset_dimensions() # The stored dimensions can't be trusted, a wrong one would cut rows off
+                for row_idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
+                    for col_idx, value in enumerate(row, start=1):
+                        if value:
+                            yield "{}!{}{}".format(ws.title, get_column_letter(col_idx), row_idx), str(value)
+        finally:
+            wb.close()
+
+    def _extract_excel_xml(self, filename, fileobj=None):
+        """
+        Generator of (location, text) for the cells of a modern excel file, read straight from the sheet XML.
+        Much faster than openpyxl. Cell values are the raw stored values, so dates come out as serial numbers.
+        """
+        with zipfile.ZipFile(filename if fileobj is None else fileobj) as archive:
+            relationships = self._ooxml_relationships(archive, "xl/workbook.xml")
+            shared_strings = []
+            for kind, target in relationships.values():
+                if kind == 'sharedStrings' and target in archive.namelist():
+                    with archive.open(target) as strings:
+                        shared_strings = self._read_shared_strings(strings)
+            sheets = []
+            with archive.open("xl/workbook.xml") as workbook:
+                for _, element in ElementTree.iterparse(workbook):
+                    if self._local_name(element.tag) == 'sheet':
+                        relationship_id = next((value for key, value in element.attrib.items() if self._local_name(key) == 'id'), None)
+                        kind, target = relationships.get(relationship_id, (None, None))
+                        if kind == 'worksheet':
+                            sheets.append((element.get('name'), target))
+            for sheet_name, target in sheets:
+                with archive.open(target) as sheet:
+                    for coordinate, value in self._read_sheet_cells(sheet, shared_strings):
+                        yield "{}!{}".format(sheet_name, coordinate), value
+
+    @staticmethod
+    def _local_name(tag):
+        return tag.rsplit("}", 1)[-1].rsplit("/", 1)[-1]
+
+    def _ooxml_relationships(self, archive, part):
+        """
+        Reads the relationships of an OOXML part, or of the package for part "", returns {id: (type, target part)}
+        with the type shortened to its last path segment.
+        """
+        directory, name = posixpath.split(part)
+        relationships = {}
+        rels_part = posixpath.join(directory, "_rels", name + ".rels")
+        if rels_part not in archive.namelist():
+            return relationships
+        with archive.open(rels_part) as rels:
+            for _, element in ElementTree.iterparse(rels):
+                if self._local_name(element.tag) == 'Relationship' and element.get('TargetMode') != 'External':
+                    target = element.get('Target', '')
+                    target = target.lstrip("/") if target.startswith("/") else posixpath.join(directory, target)
+                    relationships[element.get('Id')] = (self._local_name(element.get('Type', '')), posixpath.normpath(target))
+        return relationships
+
+    # Spreadsheet XML is regular enough to pick apart with regular expressions, which is several times faster than an XML parser
+    xml_cell = re.compile(rb"<(?:[\w.-]+:)?(?:(row)\b([^>]*)|c\b([^>]*?)(?:/>|>(.*?)</(?:[\w.-]+:)?c>))", re.S)
+    xml_attribute = re.compile(rb"""\b(r|t)\s*=\s*["']([^"']*)["']""")
+    xml_value = re.compile(rb"<(?:[\w.-]+:)?(v|f)\b[^>]*?(?:/>|>([^<]*)</)")
+    xml_text = re.compile(rb"<(?:[\w.-]+:)?t\b[^>]*?(?:/>|>([^<]*)</)")
+    xml_phonetic = re.compile(rb"<(?:[\w.-]+:)?rPh\b.*?</(?:[\w.-]+:)?rPh>", re.S)
+    xml_shared_string = re.compile(rb"<(?:[\w.-]+:)?si\b[^>]*?(?:/>|>(.*?)</(?:[\w.-]+:)?si>)", re.S)
+
+    @staticmethod
+    def _xml_blocks(stream, end_tag, block_size=4 * 1024 * 1024):
+        """
+        Generator of blocks of a decompressed XML stream, each cut just after the last end_tag (such as b'row>') in it
+        so no element inside is split between blocks.
+        """
+        carry = b""
+        while True:
+            chunk = stream.read(block_size)
+            if not chunk:
+                if carry:
+                    yield carry
+                return
+            data = carry + chunk
+            cut = data.rfind(end_tag)
+            while cut > 0 and not re.search(rb"</(?:[\w.-]+:)?$", data[max(0, cut - 64):cut]):
+                cut = data.rfind(end_tag, 0, cut)
+            if cut <= 0: # Not one complete element yet
+                carry = data
+                continue
+            cut += len(end_tag)
+            yield data[:cut]
+            carry = data[cut:]
+
+    @staticmethod
+    def _xml_unescape(text):
+        text = text.decode('utf-8', errors='replace')
+        return html.unescape(text) if "&" in text else text
+
+    def _read_shared_strings(self, stream):
+        strings = []
+        for block in self._xml_blocks(stream, b"si>"):
+            for match in self.xml_shared_string.finditer(block):
+                # Plain text is a single <t>, rich text is a <t> in each run. Phonetic hints (<rPh>) are left out.
+                content = self.xml_phonetic.sub(b"", match.group(1) or b"")
+                strings.append(self._xml_unescape(b"".join(text.group(1) or b"" for text in self.xml_text.finditer(content))))
+        return strings
+
+    prefilter_types = (FileType.DOCX, FileType.XLSX) # Formats with text the prefilter can vouch for, the rest are always parsed
+    cell_value_characters = frozenset("0123456789+-.:, #!adefilnrstuvy") # All openpyxl turns numbers, dates, booleans and errors in to
+    xml_leaf_text = re.compile(rb"<(?:[\w.-]+:)?(t|v|f)\b([^>]*?)(?:/>|>([^<]*)</)")
+    xml_formula_type = re.compile(rb"""\bt\s*=\s*["'](?!normal["'])""")
+    xml_unparsed = re.compile(rb"<!|<\?(?!xml\b)") # CDATA, comments and processing instructions
+    xml_escaped_character = re.compile(rb"_x[0-9A-Fa-f]{4}_|x005F_")
+    xml_namespace_declaration = re.compile(rb"""\bxmlns(?::([\w.-]+))?\s*=\s*["']([^"']*)["']""")
+    docx_replacements = {b"tab": b"\t", b"br": b"\n", b"cr": b"\n", b"noBreakHyphen": b"-"}
+
+    def _prefilter_clean(self, filename, filetype, fileobj):
+        """
+        Cheap check run before the full parse of a Word or Excel file. The text the parser would search is picked out of the
+        decompressed XML with regular expressions, without building a document, and the literal part of every keyword
+        is looked for in it. Returns True when no keyword can match, False when one might or the file can't be vouched for.
+        """
+        started = time() if self._timings is not None else None
+        try:
+            if filetype is FileType.XLSX and self.excel_backend != 'xml':
+                # openpyxl turns numbers, dates and booleans in to text the XML doesn't have, a keyword made only of
+                # characters found in those could match one of them
+                required = self.matcher.required_literals()
+                if required is None or any(set(literal) <= self.cell_value_characters for literal in required):
+                    return False
+            with zipfile.ZipFile(fileobj) as archive:
+                pieces = self._docx_prefilter_text(archive) if filetype is FileType.DOCX else self._xlsx_prefilter_text(archive)
+                return not self.matcher.might_match(pieces)
+        except Exception as e: # The parser gets to report it
+            self.log.success(self._prefilter_clean.__name__, filename, level='debug', prefilter_error=str(e))
             return False
+        finally:
+            fileobj.seek(0)
+            if started is not None:
+                self._add_timing('prefilter', started)
+
+    def _docx_prefilter_text(self, archive):
+        """
+        Generator of the text of the parts _extract_word_docx searches, a block at a time, with every paragraph's text
+        in one piece. None when a part has XML that isn't regular enough to pick apart, or a paragraph inside another.
+        """
+        word_namespace = self.word_namespace.strip("{}").encode('ascii')
+        for part, _ in self._docx_part_list(archive):
+            with archive.open(part) as stream:
+                leaf = None
+                for block in self._xml_blocks(stream, b"p>"):
+                    if leaf is None:
+                        prefix = next((declared for declared, uri in self.xml_namespace_declaration.findall(block) if uri == word_namespace), None)
+                        if not prefix:
+                            yield None
+                            return
+                        leaf = re.compile(rb"<" + re.escape(prefix) + rb":(t|tab|br|cr|noBreakHyphen)\b[^>]*?(?:/>|>([^<]*)</)")
+                        paragraph = re.compile(rb"<(/?)" + re.escape(prefix) + rb":p(?=[\s/>])[^>]*?(/?)>")
+                    # The elements are matched by prefix, which has to stay bound to the one namespace throughout
+                    if any((uri == word_namespace) != (declared == prefix) for declared, uri in self.xml_namespace_declaration.findall(block)):
+                        yield None
+                        return
+                    if self.xml_unparsed.search(block):
+                        yield None
+                        return
+                    # The parser takes a text box, or its fallback copy, out of the paragraph holding it, which joins
+                    # the text either side. Joining the leaves in order would put the box's text in between instead.
+                    depth = 0
+                    for match in paragraph.finditer(block):
+                        if not match.group(2): # <w:p/> has no text
+                            depth += -1 if match.group(1) else 1
+                            if not 0 <= depth <= 1:
+                                break
+                    if depth:
+                        yield None
+                        return
+                    text = b"".join(match.group(2) or b"" if match.group(1) == b"t" else self.docx_replacements[match.group(1)] for match in leaf.finditer(block))
+                    yield self._xml_unescape(text.replace(b"\r\n", b"\n").replace(b"\r", b"\n"))
+
+    def _xlsx_prefilter_text(self, archive):
+        """
+        Generator of the cell text of a modern excel file a block at a time, every shared string, inline string, value and formula
+        in one piece. Every XML part is covered, not only the sheets. None when the parser would turn the text in to something else.
+        """
+        raw = self.excel_backend == 'xml' # Takes the values as they are stored, openpyxl translates shared formulas and escapes
+        for part in archive.namelist():
+            if not part.endswith(".xml") or part == "[Content_Types].xml":
+                continue
+            with archive.open(part) as stream:
+                for block in self._xml_blocks(stream, b"si>" if part.endswith("sharedStrings.xml") else b"row>"):
+                    if self.xml_unparsed.search(block) or (not raw and self.xml_escaped_character.search(block)):
+                        yield None
+                        return
+                    text = []
+                    for match in self.xml_leaf_text.finditer(block):
+                        if match.group(1) == b"f":
+                            if not raw and self.xml_formula_type.search(match.group(2)): # Shared, array and data table formulas
+                                yield None
+                                return
+                            text.append(b"=")
+                        text.append(match.group(3) or b"")
+                    text = b"".join(text)
+                    yield self._xml_unescape(text if raw else text.replace(b"\r\n", b"\n").replace(b"\r", b"\n"))
+
+    def _read_sheet_cells(self, stream, shared_strings):
+        """
+        Generator of (coordinate, text) for the non-empty cells of a sheet, read a block of rows at a time.
+        Formula cells give the formula, the same as openpyxl.
+        """
+        row_idx = col_idx = 0
+        for block in self._xml_blocks(stream, b"row>"):
+            for match in self.xml_cell.finditer(block):
+                attributes = dict(self.xml_attribute.findall(match.group(2) if match.group(1) else match.group(3)))
+                if match.group(1): # Row start
+                    row_idx = int(attributes.get(b'r', row_idx + 1))
+                    col_idx = 0
+                    continue
+                coordinate = attributes.get(b'r')
+                if coordinate is None: # Optional, cells then follow on from each other
+                    col_idx += 1
+                    coordinate = "{}{}".format(get_column_letter(col_idx), row_idx)
+                else:
+                    coordinate = coordinate.decode('ascii')
+                    col_idx = column_index_from_string(coordinate.rstrip("0123456789"))
+                content = match.group(4)
+                if not content:
+                    continue
+                cell_type = attributes.get(b't', b'n')
+                if cell_type == b'inlineStr':
+                    value = b"".join(text.group(1) or b"" for text in self.xml_text.finditer(content))
+                else:
+                    value = formula = None
+                    for element in self.xml_value.finditer(content):
+                        if element.group(1) == b'v':
+                            value = element.group(2)
+                        else:
+                            formula = element.group(2)
+                    if formula:
+                        value = b"=" + formula
+                    elif value is None:
+                        continue
+                    elif cell_type == b's':
+                        yield coordinate, shared_strings[int(value)]
+                        continue
+                    elif cell_type == b'b':
+                        value = b"True" if value == b"1" else b"False"
+                if value:
+                    yield coordinate, self._xml_unescape(value)
 
-    def _search_excel_old_format(self, filename):
+    def _search_excel_old_format(self, filename, fileobj=None):
         """
         Searches a legacy excel file using the keywords list included in the class. 
         Writes findings to a file, using the keyword as the filename. 
         Assumes files are XLS format. 
         """
+        start = time()
         try:
-            wb = xlrd.open_workbook(filename)
-            sheets = wb.sheet_names()
-            for sheet_name in sheets:
-                ws = wb.sheet_by_name(sheet_name)
-                for row_idx in range(0, ws.nrows):    # Iterate through rows
-                    for col_idx in range(0, ws.ncols):  # Iterate through columns
-                        cell = ws.cell(row_idx, col_idx)  # Get cell object by row, col
-                        if cell.value: # Ignore empty cells
-                            for keyword in self.keywords:
-                                if re.search(keyword, str(cell.value), re.IGNORECASE):
-                                    keyword_result_file = os.path.join(self.results_dir, keyword + ".txt")
-                                    with open(keyword_result_file, 'a') as krs:
-                                        # file_basename = os.path.split(filename)[1] #Only the filename
-                                        result = filename + "---" + cell.value
-                                        krs.write(result)
-                                        krs.write("\n")
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self._search_excel_old_format.__name__,filename))
-                log_file.write('\n')
+            for location, text in self._extracted_text(filename, fileobj, self._extract_excel_old_format):
+                self._record_hits(filename, text, location)
+            self.log.success(self._search_excel_old_format.__name__, filename, duration=time() - start)
             return True
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self._search_excel_old_format.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self._search_excel_old_format.__name__, filename, e, duration=time() - start)
             return False
 
-    def _search_word_docx(self, filename):
+    def _extract_excel_old_format(self, filename, fileobj=None):
+        """
+        Generator of (location, text) for the cells of a legacy excel file.
+        Sheets are loaded one at a time and unloaded when done.
+        """
+        if fileobj is None:
+            wb = xlrd.open_workbook(filename, on_demand=True)
+        else:
+            wb = xlrd.open_workbook(file_contents=fileobj.read(), on_demand=True)
+        try:
+            for sheet_name in wb.sheet_names():
+                ws = wb.sheet_by_name(sheet_name)
+                for row_idx in range(0, ws.nrows):    # Iterate through rows
+                    for col_idx, value in enumerate(ws.row_values(row_idx)):
+                        if value: # Ignore empty cells
+                            yield "{}!{}{}".format(sheet_name, get_column_letter(col_idx + 1), row_idx + 1), str(value)
+                wb.unload_sheet(sheet_name)
+        finally:
+            wb.release_resources()
+
+    def _search_word_docx(self, filename, fileobj=None):
         """
         Searches a provided word document using the keywords list included in the class. 
         Writes findings to a file, using the keyword as the filename. 
         """
+        start = time()
         try:
-            # open connection to Word Document
-            doc = docx.Document(filename)
-        
-            # read in each paragraph in file
-            for paragraph in doc.paragraphs:
-                for keyword in self.keywords:
-                    if re.search(keyword, paragraph.text, re.IGNORECASE):
-                        keyword_result_file = os.path.join(self.results_dir, keyword + ".txt")
-                        with open(keyword_result_file, 'a') as krs:
-                            # file_basename = os.path.split(filename)[1] #Only the filename
-                            result = filename + "---" + paragraph.text
-                            krs.write(result)
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Success]{}".format(self._search_word_docx.__name__,filename))
-                log_file.write('\n')
+            for location, text in self._extracted_text(filename, fileobj, self._extract_word_docx):
+                self._record_hits(filename, text, location)
+            self.log.success(self._search_word_docx.__name__, filename, duration=time() - start)
+            return True
+        except Exception as e:
+            self.log.failure(self._search_word_docx.__name__, filename, e, duration=time() - start)
+            return False
+
+    def _extract_word_docx(self, filename, fileobj=None):
+        """
+        Generator of (location, text) for the paragraphs of a word document, parsed incrementally straight from the XML parts.
+        Covers the body including tables and text boxes, then the headers, footers, footnotes, endnotes and comments.
+        Body paragraphs are 'paragraph N', the others are prefixed with the part, e.g. 'footer1 paragraph 2'.
+        """
+        with zipfile.ZipFile(filename if fileobj is None else fileobj) as archive:
+            for part, prefix in self._docx_part_list(archive):
+                with archive.open(part) as stream:
+                    for paragraph_number, text in enumerate(self._docx_paragraphs(stream), start=1):
+                        if text:
+                            yield "{}paragraph {}".format(prefix, paragraph_number), text
+
+    def _docx_part_list(self, archive):
+        """
+        Returns the [(part, location prefix)] of a word document that are searched, the body first.
+        """
+        document = "word/document.xml"
+        for relationship_type, target in self._ooxml_relationships(archive, "").values():
+            if relationship_type == 'officeDocument':
+                document = target
+        parts = [(document, "")]
+        related = self._ooxml_relationships(archive, document).values()
+        for part_type in self.docx_parts:
+            for relationship_type, target in sorted(related):
+                if relationship_type == part_type and target in archive.namelist():
+                    parts.append((target, posixpath.splitext(posixpath.basename(target))[0] + " "))
+        return parts
+
+    docx_parts = ('header', 'footer', 'footnotes', 'endnotes', 'comments') # Searched after the body, in this order
+    word_namespace = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    compatibility_fallback = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+    def _docx_paragraphs(self, stream):
+        """
+        Generator of the text of each paragraph in a WordprocessingML part, in document order. 
+        Paragraphs are cleared once read so memory stays flat. A text box inside a paragraph comes out as its own paragraphs, before the one holding it.
+        """
+        w = self.word_namespace
+        text_tags = {w + 't': None, w + 'tab': "\t", w + 'br': "\n", w + 'cr': "\n", w + 'noBreakHyphen': "-"}
+        for _, paragraph in etree.iterparse(stream, events=('end',), tag=w + 'p', huge_tree=True):
+            if next(paragraph.iterancestors(self.compatibility_fallback), None) is None: # Text boxes are stored twice, the fallback copy is skipped
+                text = []
+                for element in paragraph.iter(*text_tags):
+                    replacement = text_tags[element.tag]
+                    text.append((element.text or "") if replacement is None else replacement)
+                yield "".join(text)
+            paragraph.clear() # Also keeps a text box's text out of the paragraph holding it
+            while paragraph.getprevious() is not None:
+                del paragraph.getparent()[0]
+
+    def _search_pdf(self, filename, fileobj=None):
+        """
+        Searches a PDF page by page as the pages are extracted.
+        Extraction runs in a separate process which is killed if the file takes longer than pdf_timeout, 
+        a page takes longer than pdf_page_timeout, or it runs out of memory. Parsers have proven to hang on some files.
+        """
+        start = time()
+        try:
+            for location, text in self._extracted_text(filename, fileobj, self._extract_pdf, self._pdf().backend):
+                self._record_hits(filename, text, location)
+            self.log.success(self._search_pdf.__name__, filename, duration=time() - start)
             return True
+
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self._search_word_docx.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self._search_pdf.__name__, filename, e, duration=time() - start)
             return False
 
-    def _search_pdf(self, filename):
+    def _pdf(self):
+        if self._pdf_extractor is None:
+            self._pdf_extractor = PdfExtractor(self.pdf_backend, self.pdf_timeout, self.pdf_page_timeout, self.pdf_memory_limit)
+        return self._pdf_extractor
+
+    def _extract_pdf(self, filename, fileobj=None):
+        """
+        Generator of (location, text) for the pages of a PDF, each page as soon as the extraction process has it.
+        """
+        for page_number, text in self._pdf().pages(filename, fileobj):
+            yield "page {}".format(page_number), text
+
+    def _extracted_text(self, filename, fileobj, extract, variant=""):
+        """
+        Generator of the (location, text) segments from an extract method, taken from the extract cache when the same content
+        has been parsed before. Segments are passed on as the parser produces them, and cached once it has finished.
+        variant tells apart extractors that produce different text from the same file, such as the PDF backends.
+        """
+        if self.extract_cache is None:
+            yield from extract(filename, fileobj)
+            return
+        key = self.extract_cache.key(extract.__name__ + variant, filename, fileobj)
+        segments = self.extract_cache.get(key)
+        if segments is not None:
+            yield from segments
+            return
+        segments, size = [], 0
+        for segment in extract(filename, fileobj):
+            if segments is not None:
+                segments.append(segment)
+                size += len(segment[1])
+                if size > self.extract_cache.max_entry_size: # Not worth holding the whole document in memory for
+                    segments = None
+            yield segment
+        if segments is not None:
+            self.extract_cache.put(key, segments)
+
+    def _archive_members(self, filename, kind, fileobj=None, depth=0, name=None):
+        """
+        Generator of (member name, stream) for the regular files in an archive, read straight from the archive without extracting anything.
+        Each stream has to be finished with before asking for the next member.
+        Compressed files that aren't a tar inside are treated as an archive with a single member named after the file.
+        name is the archive's own name when it is a member of another archive, the base name of filename otherwise.
+        """
+        with open(filename, 'rb') if fileobj is None else nullcontext(fileobj) as source:
+            if kind is FileType.ZIP:
+                if depth > 0 and not isinstance(source, io.BytesIO): # Zip needs random access, seeking inside a compressed member would decompress it again and again
+                    source = self._read_member(filename, source)
+                    if source is None:
+                        return
+                with zipfile.ZipFile(source) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            with archive.open(info) as member:
+                                yield info.filename, member
+                return
+            if kind is FileType.GZIP:
+                source = gzip.GzipFile(fileobj=source)
+            elif kind is FileType.BZIP2:
+                source = bz2.BZ2File(source)
+            elif kind is FileType.XZ:
+                source = lzma.LZMAFile(source)
+            if kind is FileType.TAR or self._is_tar(source.peek(tarfile.BLOCKSIZE)[:tarfile.BLOCKSIZE]):
+                with tarfile.open(fileobj=source, mode='r|') as archive: # Stream mode, members are read in order and never seeked
+                    for info in archive:
+                        if info.isfile():
+                            yield info.name, archive.extractfile(info)
+            else:
+                yield os.path.splitext(posixpath.basename(name) if name is not None else os.path.basename(filename))[0], source
+
+    @staticmethod
+    def _is_tar(header):
         try:
-            with stopit.ThreadingTimeout(20) as to_ctx_mgr: ##Exit if a PDF takes too long to extract. The 'page.extractText()' function has proven to hang in some cases. 
-                assert to_ctx_mgr.state == to_ctx_mgr.EXECUTING, "Failed to extract text from PDF." 
-                with open(filename,'rb') as pdf_file:
-                    read_pdf = PyPDF2.PdfFileReader(pdf_file, strict=False) ##Read and supress warnings
-                    if read_pdf.isEncrypted:
-                        with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                            log_file.write("[{}]{} --- {}".format(self._search_pdf.__name__,filename, "File is encrypted, unable to parse."))
-                            log_file.write('\n')
-                        return False
-                    number_of_pages = read_pdf.getNumPages()
-                    for page_number in range(number_of_pages):
-                        page = read_pdf.getPage(page_number)
-                        page_content = page.extractText()
-                        for keyword in self.keywords:
-                            if re.search(keyword, page_content, re.IGNORECASE):
-                                keyword_result_file = os.path.join(self.results_dir, keyword + ".txt")
-                                with open(keyword_result_file, 'a') as krs:
-                                    result = filename + "---" + page_content
-                                    krs.write(result)
-
-                with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                    log_file.write("[{} Success]{}".format(self._search_pdf.__name__,filename))
-                    log_file.write('\n')
-                return True
+            tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape") # Validates the header checksum
+            return True
+        except Exception:
+            return False
 
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT: ##Custom error log for failed PDF searches
-                raise RuntimeError("Unable to extract text from PDF or the process took to long.")
+    def _read_member(self, filename, fileobj):
+        """
+        Reads an archive member in to memory for the parsers that need to seek. Returns None if it is over max_member_size.
+        """
+        data = fileobj.read(self.max_member_size + 1)
+        if len(data) > self.max_member_size:
+            self.log.failure(self._read_member.__name__, filename, "Member is larger than {} bytes, skipped.".format(self.max_member_size))
+            return None
+        return io.BytesIO(data)
 
+    def _search_archive(self, filename, kind, fileobj=None, depth=0, name=None):
+        """
+        Searches every member of an archive without writing anything to disk, recursing in to nested archives up to max_archive_depth.
+        Members are reported as 'archive!member', the member name is passed on alongside so nothing has to parse it back out of that path.
+        Returns False if the archive itself couldn't be read, a member that fails is only logged.
+        """
+        start = time()
+        if depth >= self.max_archive_depth:
+            self.log.failure(self._search_archive.__name__, filename, "Archives are nested deeper than {} levels.".format(self.max_archive_depth))
+            return False
+        try:
+            for member_name, member in self._archive_members(filename, kind, fileobj, depth, name):
+                self._detect_and_search(filename + self.archive_separator + member_name, member, depth + 1, name=member_name)
+            self.log.success(self._search_archive.__name__, filename, duration=time() - start)
+            return True
         except Exception as e:
-            with open(self.log_file, 'a', encoding=self.system_encoding) as log_file:
-                log_file.write("[{} Failure]{} --- {}".format(self._search_pdf.__name__,filename, str(e)))
-                log_file.write('\n')
+            self.log.failure(self._search_archive.__name__, filename, e, duration=time() - start)
             return False
 
     def _search_rich_text(self, filename):
@@ -481,98 +2909,663 @@ class FileSearcher:
                 # with open(self.log_file, 'a') as logfile:
                 #     logfile.write(newline)
 
-    def process_directory(self, directory):
+    def _search_file(self, filename, keywords=None, source=None, data=None):
+        """
+        Detects the file type and searches the file with the matching method. 
+        Returns the disposition of the file: 'processed', 'error', 'unsupported' or 'archive' when it still needs to be uncompressed.
+        keywords limits the search to a subset of the keywords, such as the ones added since the file was last searched.
+        source is the path to open when it isn't the filename used in the results, see display_path.
+        data is the file's contents when it was read ahead, the file isn't opened then.
+        With metrics on, the time each stage took is left in _timings and the detected type in _timed_type.
+        While process_directory is collecting stats the mime type is left in _file_mime.
+        Parses the prefilter skipped are left in _prefiltered.
+        """
+        if self.use_metrics:
+            self._timings, self._timed_type = {}, FileType.UNKNOWN.value
+        self._file_mime = None
+        self._prefiltered = {}
+        fileobj = io.BytesIO(data) if data is not None else None
+        if keywords is None or keywords == self.matcher.keywords:
+            return self._detect_and_search(filename, fileobj, source=source)
+        matcher = self.matcher
+        if keywords not in self._matchers:
+            self._matchers[keywords] = KeywordMatcher(keywords)
+        self.matcher = self._matchers[keywords]
+        try:
+            return self._detect_and_search(filename, fileobj, source=source)
+        finally:
+            self.matcher = matcher
+
+    def _detect_and_search(self, filename, fileobj=None, depth=0, source=None, name=None):
+        """
+        Opens the file once, classifies it from its header and hands the same handle to the parser.
+        fileobj, depth and name are set for archive members, filename is then the 'archive!member' path used in the results
+        and name the member's name inside its archive.
+        fileobj is also set at depth 0 for a file that was read ahead.
+        source is the path to open when it isn't filename.
+        """
+        if fileobj is None:
+            try:
+                file = open(long_path(source or filename), 'rb')
+            except OSError as e:
+                self.log.failure(self._detect_and_search.__name__, filename, e)
+                return 'error'
+            with file:
+                return self._detect_and_search(filename, file, depth)
+        started = time() if self._timings is not None and depth == 0 else None
+        try:
+            header = self._peek(fileobj, self.classifier.header_size)
+            if depth > 0 and header.startswith(b"PK"):
+                # Zip based files need random access to classify and to parse, archive members are read in to memory first
+                fileobj = self._read_member(filename, fileobj)
+                if fileobj is None:
+                    return 'error'
+            filetype = self.classifier.classify(header, filename if name is None else name, fileobj)
+            self.log.success(self.classifier.classify.__name__, filename, filetype=filetype.value)
+        ##Unable to determine file type
+        except Exception as e:
+            self.log.failure(self.classifier.classify.__name__, filename, e)
+            return 'error'
+        if started is not None:
+            self._add_timing('classify', started)
+            self._timed_type = filetype.value
+            started = time()
+        if self._collect_stats and depth == 0:
+            try:
+                self._file_mime = self.classifier.mime(header, filetype) # libmagic's answer is cached from classifying
+            except Exception as e:
+                self.log.failure(self.classifier.mime.__name__, filename, e)
+        # Compressed files
+        if filetype.is_archive:
+            if not self.stream_archives:
+                # Old behaviour, gzip files are extracted to disk by process_directory. Anything else is unsupported.
+                return 'archive' if depth == 0 and filetype is FileType.GZIP else 'unsupported'
+            searched = self._search_archive(filename, filetype, fileobj, depth, name)
+        else:
+            ##Unsupported files
+            if filetype not in self.parsers:
+                return 'unsupported'
+            search = getattr(self, self.parsers[filetype])
+            if depth > 0 and filetype is not FileType.TEXT and not isinstance(fileobj, io.BytesIO):
+                # Everything but plain text needs to seek, archive members are read in to memory first
+                fileobj = self._read_member(filename, fileobj)
+                if fileobj is None:
+                    return 'error'
+            if self.prefilter and filetype in self.prefilter_types and self._prefilter_clean(filename, filetype, fileobj):
+                self._prefiltered[filetype.value] = self._prefiltered.get(filetype.value, 0) + 1
+                searched = True # Nothing in it can match, it's done without building the document
+            else:
+                searched = search(filename, fileobj)
+        if started is not None: # Matching happens as the parser goes, it's timed on its own
+            self._timings['parse'] = time() - started - self._timings.get('match', 0.0) - self._timings.get('prefilter', 0.0)
+        return 'processed' if searched else 'error'
+
+    @staticmethod
+    def _peek(fileobj, size):
+        """
+        Returns up to size bytes from the start of a stream without consuming them.
+        """
+        if hasattr(fileobj, 'peek'):
+            return fileobj.peek(size)[:size]
+        header = fileobj.read(size)
+        fileobj.seek(0)
+        return header
+
+    def _search_files(self, queue, workers=1, max_pending=None):
+        """
+        Searches the files in the work queue, yielding (filename, disposition) as they finish. 
+        With more than one worker the files are detected, parsed and matched in a pool of worker processes. 
+        The hits and log records come back to this process, which is the only one writing results. 
+        At most max_pending files are handed to the pool at a time so memory stays bounded no matter how many files there are. 
+        Files added to the queue while this runs, such as extracted archive members, are picked up before it finishes.
+        With read ahead on, the files are read in to memory ahead of time and the buffers are searched, or sent to the workers.
+        """
+        if workers <= 1:
+            while True:
+                upcoming = self._next_item(queue)
+                if upcoming is None:
+                    return
+                item, held = upcoming
+                data = self._take_buffer(item[0])
+                if not held:
+                    status = self._search_file(*item, data)
+                else: # The hits are kept to be copied to the duplicates
+                    results, self.results = self.results, MemorySink()
+                    start = time()
+                    try:
+                        status = self._search_file(*item, data)
+                    finally:
+                        hits, self.results = self.results.drain(), results
+                    self.results.write_many(hits)
+                    self._keep_duplicate_hits(item[0], hits, time() - start)
+                del data
+                if self.read_ahead is not None:
+                    self.read_ahead.done(item[0])
+                self._keep_timings(item[0])
+                self._keep_mime(item[0], self._file_mime)
+                self._keep_prefiltered(self._prefiltered)
+                yield item[0], status
+
+        max_pending = max_pending or workers * 4
+        pool = self._worker_pool(workers)
+        try:
+            pending = {}
+            while True:
+                upcoming = self._next_item(queue)
+                if upcoming is not None:
+                    item = upcoming[0]
+                    data = self._take_buffer(item[0])
+                    try:
+                        pending[pool.submit(_search_in_worker, *item, data)] = item[0]
+                    except BrokenProcessPool as e:
+                        # A worker died and took the pool down, everything in flight failed with it. The rest goes to a new pool.
+                        self.log.failure(self._search_files.__name__, None, e)
+                        for future in list(pending):
+                            yield self._collect(future, pending.pop(future))
+                        pool.shutdown(wait=False)
+                        pool = self._worker_pool(workers)
+                        pending[pool.submit(_search_in_worker, *item, data)] = item[0]
+                    del data
+                    if len(pending) < max_pending:
+                        continue
+                elif not pending: # Nothing left to walk, queued or in flight
+                    return
+                # Backpressure, or the queue is empty for now. Wait for a worker, finishing a file can queue more.
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._collect(future, pending.pop(future))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _worker_pool(self, workers):
+        """
+        Starts a pool of worker processes searching files for _search_files.
+        """
+        # Forked workers inherit copies of the buffered handles, flush first so nothing gets written twice
+        self.results.flush()
+        self.log.flush()
+        # A fork only copies the thread doing it, a read ahead thread holding a lock at that moment would leave it held for good
+        context = multiprocessing.get_context('spawn') if self.read_ahead is not None else None
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,), mp_context=context)
+
+    def _next_item(self, queue):
+        """
+        Returns the next (item, held) to search, item being what _prepare returned and held whether its hits are kept for duplicates,
+        or None when there is nothing left right now. With read ahead on, the files after it are prepared too and their reads started.
+        """
+        depth = self.read_ahead.depth if self.read_ahead is not None else 1
+        while len(self._ahead) < depth:
+            filename = queue.next_file()
+            if filename is None:
+                break
+            item = self._prepare(filename)
+            if item is None:
+                self._release_duplicates(filename, queue)
+                continue
+            held = self._hold_duplicates(filename, item)
+            if self.read_ahead is not None:
+                self.read_ahead.submit(item[0], item[2] or item[0])
+            self._ahead.append((item, held))
+        return self._ahead.popleft() if self._ahead else None
+
+    def _take_buffer(self, filename):
+        """
+        Returns the contents read ahead for a file, or None when it's to be opened as usual. Waiting on the read is timed as 'read_wait'.
+        """
+        if self.read_ahead is None:
+            return None
+        data, stalled = self.read_ahead.take(filename)
+        if self.metrics is not None:
+            self.metrics.observe('read_wait', stalled)
+        return data
+
+    def _collect(self, future, filename):
+        """
+        Writes out the hits, log records and extracted text a worker process returned for a file.
+        """
+        if self.read_ahead is not None:
+            self.read_ahead.done(filename)
+        try:
+            filename, status, hits, log_records, segments, cache_counts, duration, timings, mime, prefiltered = future.result()
+        except Exception as e: # The worker died, most likely a parser crashing the interpreter
+            self.log.failure(self._search_files.__name__, filename, e)
+            self._keep_duplicate_hits(filename, [], 0.0)
+            self._keep_timings(filename)
+            return filename, 'error'
+        self.results.write_many(hits)
+        self._keep_duplicate_hits(filename, hits, duration)
+        self._keep_timings(filename, timings)
+        self._keep_mime(filename, mime)
+        self._keep_prefiltered(prefiltered)
+        if segments:
+            self.index.add_many(segments)
+        if cache_counts:
+            self.extract_cache.merge(cache_counts)
+        self.log.write_records(log_records)
+        return filename, status
+
+    def _hold_duplicates(self, filename, item):
+        """
+        Notes the duplicates of a file that is about to be searched, filename being the path from the walk and item the prepared (filename, keywords).
+        Returns True when it has duplicates waiting for its hits.
+        """
+        found = self.duplicates.take(os.fspath(filename)) if self.duplicates is not None else None
+        if found is None:
+            return False
+        self._duplicate_pending[item[0]] = (found[0], found[1], item[1])
+        return True
+
+    def _release_duplicates(self, filename, queue):
+        """
+        Queues the duplicates of a file that won't be searched, so they are searched themselves.
+        """
+        found = self.duplicates.take(os.fspath(filename)) if self.duplicates is not None else None
+        if found is not None:
+            queue.add(found[1])
+
+    def _keep_timings(self, filename, timings=None):
+        """
+        Adds the stage timings of a searched file to the ones taken while preparing it, timings being the (file type, {stage: seconds})
+        a worker returned, or None to take them from this process.
+        """
+        if self.metrics is None:
+            return
+        if timings is None:
+            timings = (self._timed_type, self._timings) if self._timings is not None else (FileType.UNKNOWN.value, {})
+            self._timings = None
+        filetype, stages = self._file_timings.get(filename, (None, {}))
+        stages.update(timings[1])
+        self._file_timings[filename] = (timings[0], stages)
+
+    def _keep_mime(self, filename, mime):
+        if self._collect_stats and mime is not None:
+            self._file_mimes[filename] = mime
+
+    def _keep_prefiltered(self, prefiltered):
+        for filetype, count in prefiltered.items():
+            self.prefilter_skipped[filetype] = self.prefilter_skipped.get(filetype, 0) + count
+
+    def _keep_duplicate_hits(self, filename, hits, duration):
+        if filename in self._duplicate_pending:
+            self._duplicate_hits[filename] = self._duplicate_pending.pop(filename) + (hits, duration)
+
+    def _settle_duplicates(self, queue, directory, filename, status, searched=True):
+        """
+        Deals with the duplicates of a file once it has been searched and moved. Duplicates that only need keywords the file was
+        searched for get its hits under their own path and the same disposition without being opened, the rest are queued to be searched.
+        searched is False when the file wasn't searched itself, such as a gzip file extracted for its members to be searched.
+        Returns the number of duplicates that were given the file's hits.
+        """
+        copied = 0
+        size, duplicates, keywords, hits, duration = self._duplicate_hits.pop(filename)
+        for duplicate in duplicates:
+            item = self._prepare(duplicate) # Renames it and checks the manifest like any other file
+            if item is None:
+                queue.discovered += 1
+                continue
+            copy_to, needed = item[:2]
+            if not searched or not (keywords is None or (needed is not None and needed <= keywords)):
+                self._manifest_pending.pop(copy_to, None) # Prepared again when it comes off the queue
+                queue.add([copy_to])
+                continue
+            queue.discovered += 1
+            self.results.write_many((keyword, copy_to + path[len(filename):], context, location)
+                                    for keyword, path, context, location in hits if needed is None or keyword in needed)
+            self.log.success(self._settle_duplicates.__name__, copy_to, duplicate_of=filename)
+            self._dispose(directory, copy_to, status)
+            self.duplicates.copied(size, duration)
+            queue.completed += 1
+            copied += 1
+        return copied
+
+    def _dispose(self, directory, filename, status):
+        """
+        Moves a searched file to the directory matching its disposition and records it in the manifest.
+        When grouping, the file goes under a directory named after its extension inside the disposition directory.
+        In read only mode the file stays where it is and the disposition goes to the report.
+        """
+        group = Path(filename).suffix.lower().replace(".", "") if self._group else None
+        if self.read_only:
+            destination = filename
+            self.report.record(filename, status)
+        elif status == 'processed':
+            destination = self.organize(directory, filename, group=group)
+        elif status == 'unsupported':
+            destination = self.organize(directory, filename, supported=False, group=group)
+        else:
+            destination = self.organize(directory, filename, error=True, group=group)
+        if self.manifest is not None:
+            size, mtime, digest, keywords = self._manifest_pending.pop(filename)
+            self.manifest.record(destination or filename, filename, size, mtime, digest, status, keywords)
+
+    def _prepare(self, filename):
+        """
+        Renames the file if needed and works out which keywords it needs to be searched for.
+        filename can be a path or the os.DirEntry from the walk, whose stat data is used rather than fetching it again.
+        Returns (filename, keywords, source), keywords being None for all of them, or None when the manifest says the file is up to date.
+        In read only mode files aren't renamed, a name that can't be written as UTF-8 is reported under its display_path
+        and source is the real path, otherwise source is None.
+        """
+        started = time() if self.metrics is not None else None
+        entry = filename if isinstance(filename, os.DirEntry) else None
+        filename = source = os.fspath(filename)
+        if self.read_only:
+            filename = display_path(source)
+        else:
+            new_filename = self.rename_file(filename) # See if the file needed to be renamed. 
+            if new_filename:
+                filename = source = new_filename
+                entry = None # Its stat data may not have been fetched yet, and the old path is gone
+        source = source if source != filename else None
+        if self.manifest is None:
+            if started is not None:
+                self._file_timings[filename] = (None, {'prepare': time() - started})
+            return filename, None, source
+        try:
+            stat = entry.stat(follow_symlinks=False) if entry is not None else os.stat(source or filename)
+            digest = ScanManifest.file_hash(source or filename) if self.manifest_hash else None
+        except OSError as e:
+            self.log.failure(self._prepare.__name__, filename, e)
+            return None
+        keywords = self.manifest.keywords_needed(filename, stat.st_size, stat.st_mtime, self.keywords, digest)
+        if keywords is None:
+            self.skipped_files += 1
+            return None
+        searched_before = self.manifest.lookup(filename)
+        covered = keywords
+        if searched_before is not None and keywords != self.keywords: # Only the new keywords are searched, the record covers both
+            covered = keywords | self.manifest.keywords_for(searched_before['keyword_version'])
+        self._manifest_pending[filename] = (stat.st_size, stat.st_mtime, digest, covered)
+        if started is not None:
+            self._file_timings[filename] = (None, {'prepare': time() - started})
+        return filename, keywords, source
+
+    def __getstate__(self):
+        # Sent to the worker processes, which get their own results and log buffers
+        state = self.__dict__.copy()
+        state['results'] = None
+        state['log'] = None
+        state['index'] = None
+        state['manifest'] = None # Only this process reads and writes the manifest
+        state['_manifest_pending'] = {}
+        state['_pdf_extractor'] = None
+        state['duplicates'] = None
+        state['_duplicate_pending'] = {}
+        state['_duplicate_hits'] = {}
+        state['metrics'] = None
+        state['report'] = None
+        state['_file_timings'] = {}
+        state['_file_mimes'] = {}
+        state['read_ahead'] = None
+        state['_ahead'] = deque()
+        state['prefilter_skipped'] = {}
+        return state
+
+    def process_directory(self, directory, workers=1, max_pending=None, precount=False, stats=False, group=False):
         """ 
         Search files by trying to check the file type and use the appropriate method to parse. 
+        workers sets how many processes detect, parse and match files, this process walks the tree and owns the results and file moves.
+        max_pending caps how many files are handed to the workers at once, defaults to four per worker.
+        precount counts the files first so the progress bar has a real total and ETA, otherwise the total grows as the walk goes.
+        With the manifest enabled, files that haven't changed since they were searched with the current keywords are skipped,
+        and files searched with an older keyword list are only searched for the keywords that are new.
+        With dedup enabled the whole tree is walked first and only one copy of each distinct file is searched,
+        its hits are copied to the identical files, which are moved along with it.
+        stats counts the mime types of the files searched, from the header already read to classify them, and writes Output/stats.json.
+        group moves files under a directory named after their extension, as group_by_extension does, but in the same move as organize.
+        With read ahead enabled the next files are read in to memory on background threads while the current one is parsed.
+        Archives are extracted in the same pass too, so stats, grouping, extraction and searching cost one walk and one read per file.
+        Returns the file type stats when stats is on.
         """
-        start_at_beginning = True # Used to restart the inner for loop as needed. 
-        while start_at_beginning is True:
-            start_at_beginning = False # Inner for loop must set this back to True if needed
-
-            print("\nStarting from the beginning, generating a new list of file names. . .\n")
-            filename_gen = self.generate_filenames(directory)
-
-            print("\nDetecting file types and attempting to search. . .\n")
-            for filename in tqdm(filename_gen, desc="Progress", total=self.estimated_files): #Can't find a good way to show progress while using a generator. Tried to use a list but ran into memory errors
-                if self.rename_file(filename): # See if the file needed to be renamed. 
-                    filename = self.rename_file(filename)
-                filetype = self.get_file_magic(filename)
-                if filetype:
-                    # Compressed files
-                    if ".tar.gz" in filename.lower() or "gzip compressed data" in filetype.lower(): # Experienced some issues with python-magic classifying gzip files, using the less reliable file name as well. 
-                        print(f"\nInspecting compressed file --- {filename}\n")
-                        if self.uncompress_tar(filename, directory): # Uncompress file and save in the same directory
-                            self.organize(directory, filename)
-                            start_at_beginning = True #When we uncompress a file, new files are expected. Time to restart with a new file generator. 
-                            print("\nNew files have been uncompressed. Starting from the beginning. . .\n")
-                            break
-                        else:
-                            self.organize(directory, filename, error=True)
-                    # Text Files
-                    elif "text" in filetype.lower():
-                        if self._search_plaintext(filename):
-                            self.organize(directory, filename)
-                        else:
-                            self.organize(directory, filename, error=True)
-                    # Modern Excel Files
-                    elif "Microsoft Excel 2007+" in filetype:
-                        if self._search_excel(filename):
-                            self.organize(directory, filename)
-                        else:
-                            self.organize(directory, filename, error=True)
-                    # Old Excel Files
-                    elif (".xls" in filename) and ("Composite Document File V2 Document, Little Endian" in filetype or "CDFV2 Microsoft Excel" in filetype):
-                        if self._search_excel_old_format(filename):
-                            self.organize(directory, filename)
-                        else:
-                            self.organize(directory, filename, error=True)
-                    # Modern Word Files
-                    elif "Microsoft Word 2007+" in filetype:
-                        if self._search_word_docx(filename):
-                            self.organize(directory, filename)
-                        else:
-                            self.organize(directory, filename, error=True)
-                    ##PDF Files
-                    elif "PDF document" in filetype:
-                        if self._search_pdf(filename):
-                            self.organize(directory, filename)
-                        else:
-                            self.organize(directory, filename, error=True)
-                    ##Unsupported files
+        self.skipped_files = 0 # Files the manifest says are already up to date
+        self.prefilter_skipped = {}
+        self._collect_stats, self._group = stats, group
+        self._file_mimes = {}
+        file_type_stats = {'total':0}
+        last_flush = time()
+        total = self.count_files(directory, workers=workers) if precount else 0
+        entries = self.generate_entries(directory)
+        if self.dedup:
+            self.duplicates = DuplicateFinder()
+            entries = self.duplicates.representatives(entries, on_error=lambda path, e: self.log.failure(DuplicateFinder.representatives.__name__, path, e))
+        queue = WorkQueue(entries)
+        self._ahead = deque()
+        if self.use_read_ahead:
+            self.read_ahead = ReadAhead(self.read_ahead_threads, self.read_ahead_depth, self.read_ahead_files, self.read_ahead_bytes, self.read_ahead_file_size)
+
+        print("\nDetecting file types and attempting to search. . .\n")
+        progress = tqdm(desc="Progress", unit="file", total=total)
+        try:
+            for filename, status in self._search_files(queue, workers=workers, max_pending=max_pending):
+                searched = status != 'archive'
+                if status == 'archive': # Only when stream_archives is off
+                    print(f"\nInspecting compressed file --- {filename}\n")
+                    extracted = self.uncompress_tar(filename, directory) # Uncompress file and save in the same directory
+                    if extracted is not False:
+                        queue.add(extracted) # Searched along with everything else, no need to walk the tree again
+                        status = 'processed'
                     else:
-                        self.organize(directory, filename, supported=False)
-                ##Unable to determine file type
-                else:
-                    self.organize(directory, filename, error=True)
-            
+                        status = 'error'
+                started = time() if self.metrics is not None else None
+                self._dispose(directory, filename, status)
+                if started is not None:
+                    self._record_file_metrics(filename, status, time() - started)
+                queue.completed += 1
+                mime = self._file_mimes.pop(filename, None)
+                copies = 0
+                if filename in self._duplicate_hits:
+                    copies = self._settle_duplicates(queue, directory, filename, status, searched)
+                if mime is not None:
+                    file_type_stats['total'] += 1 + copies
+                    file_type_stats[mime] = file_type_stats.get(mime, 0) + 1 + copies
+                progress.total = max(total, queue.discovered) # Grows as the walk goes, the walk itself is never repeated
+                progress.set_postfix(discovered=queue.discovered, queued=queue.discovered - queue.completed - self.skipped_files, completed=queue.completed, skipped=self.skipped_files, refresh=False)
+                progress.update(queue.completed + self.skipped_files - progress.n)
+                if time() - last_flush >= self.flush_interval:
+                    started = time()
+                    self.flush()
+                    if self.metrics is not None:
+                        self.metrics.observe('flush', time() - started)
+                    last_flush = time()
+        finally:
+            if self.read_ahead is not None:
+                self.read_ahead.close()
+        progress.close()
+        self.flush()
+        cache_stats = {}
+        if self.extract_cache is not None:
+            cache_stats = {'cache_hits': self.extract_cache.hits, 'cache_misses': self.extract_cache.misses}
+            print("\nExtract cache: {cache_hits} hits, {cache_misses} misses\n".format(**cache_stats))
+        dedup_stats = {}
+        if self.duplicates is not None:
+            dedup_stats = {'duplicates': self.duplicates.files, 'dedup_bytes_saved': self.duplicates.bytes_saved, 'dedup_seconds_saved': round(self.duplicates.time_saved, 3)}
+            print("\nDeduplication: {duplicates} duplicate files, {dedup_bytes_saved} bytes and {dedup_seconds_saved}s of searching saved\n".format(**dedup_stats))
+            self.duplicates = None
+        prefilter_stats = {}
+        if self.prefilter:
+            prefilter_stats = {'prefilter_skipped': sum(self.prefilter_skipped.values())}
+            print("\nPrefilter: {} parses skipped{}\n".format(prefilter_stats['prefilter_skipped'],
+                  "".join(", {} {}".format(count, filetype) for filetype, count in sorted(self.prefilter_skipped.items()))))
+        read_ahead_stats = {}
+        if self.read_ahead is not None:
+            read_ahead_stats = self.read_ahead.stats()
+            print("\nRead ahead: {read_ahead_files} files ({read_ahead_bytes} bytes) from memory, {read_ahead_skipped} opened directly, "
+                  "waited on {read_ahead_stalls} reads for {read_ahead_stall_seconds}s\n".format(**read_ahead_stats))
+            self.read_ahead = None
+        self.log.info("finished", self.process_directory.__name__, directory, discovered=queue.discovered, completed=queue.completed, skipped=self.skipped_files, **cache_stats, **dedup_stats, **read_ahead_stats, **prefilter_stats)
+        if self.walker.shard is not None:
+            self._write_bundle(directory, queue, file_type_stats if stats else None)
+        if self.metrics is not None:
+            self.metrics.write()
+            print("\nSlowest files:")
+            for item in self.metrics.slowest_files()[:10]:
+                print("{:10.3f}s  {}  {}  ({})".format(item['seconds'], item['type'], item['path'], ", ".join("{} {:.3f}s".format(stage, seconds) for stage, seconds in item['stages'].items())))
+            print("Metrics written to {}\n".format(self.metrics.metrics_file))
+        self._collect_stats = self._group = False
+        if stats:
+            return self.write_filetype_stats(file_type_stats)
+
+    def _write_bundle(self, directory, queue, file_type_stats):
+        """
+        Writes Output/bundle.json once a shard has finished, saying which partition of which scan the Output directory holds.
+        merge_bundles reads it to combine the shards.
+        """
+        self.flush() # Everything the bundle covers is on disk before it's marked finished
+        bundle = {
+            'shard': self.walker.shard[0], 'shards': self.walker.shard[1], 'shard_by': self.walker.shard_by,
+            'search_dir': os.path.abspath(directory), 'keyword_version': ScanManifest.keyword_version(self.keywords),
+            'results_backend': self.results_backend, 'read_only': self.read_only,
+            'discovered': queue.discovered, 'completed': queue.completed, 'skipped': self.skipped_files,
+            'stats': file_type_stats, 'prefilter_skipped': self.prefilter_skipped, 'finished': round(time(), 3),
+        }
+        bundle_file = os.path.join(self.output_dir, "bundle.json")
+        with open(bundle_file + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(bundle, file, indent=4, ensure_ascii=False)
+        os.replace(bundle_file + ".tmp", bundle_file) # Only ever seen complete, its presence means the shard is done
+        self.log.success(self._write_bundle.__name__, bundle_file, level='info')
+
+    def _record_file_metrics(self, filename, status, organize_seconds):
+        """
+        Hands the stage timings of a finished file to the metrics, along with the time it took to move.
+        """
+        filetype, stages = self._file_timings.pop(filename, (None, {}))
+        stages['organize'] = organize_seconds
+        self.metrics.file_done(filename, filetype or FileType.UNKNOWN.value, status, stages)
+
+    def query_index(self, keywords_file=None):
+        """
+        Answers a keyword list from the index an earlier run built with index=True, without opening any of the files.
+        Hits are written to the results the same way a search writes them. keywords_file defaults to the searcher's own keywords.
+        Returns the number of hits.
+        """
+        start = time()
+        keywords = read_keywords(keywords_file) if keywords_file else self.keywords
+        index = self.index
+        if index is None:
+            index = TextIndex(os.path.join(self.output_dir, "index.db"))
+        else:
+            index.flush()
+        hits = 0
+        try:
+            for record in index.search(keywords):
+                self.results.write(*record)
+                hits += 1
+        finally:
+            if index is not self.index:
+                index.close()
+        self.flush()
+        self.log.info("queried", self.query_index.__name__, index.index_file, duration=time() - start, keywords=len(keywords), hits=hits)
+        return hits
+
+# Set up in each worker process by process_directory when running with more than one worker
+_worker_searcher = None
+
+def _init_worker(searcher):
+    global _worker_searcher
+    searcher.results = MemorySink()
+    searcher.log = RunLog(None, verbosity=searcher.log_verbosity)
+    if searcher.use_index:
+        searcher.index = MemoryIndex()
+    if searcher.extract_cache is not None:
+        searcher.extract_cache.drain() # Counts are reported by the parent, start from zero
+    _worker_searcher = searcher
+
+def _search_in_worker(filename, keywords=None, source=None, data=None):
+    start = time()
+    status = _worker_searcher._search_file(filename, keywords, source, data)
+    timings = (_worker_searcher._timed_type, _worker_searcher._timings) if _worker_searcher.use_metrics else None
+    mime = _worker_searcher._file_mime
+    segments = _worker_searcher.index.drain() if _worker_searcher.index is not None else None
+    cache_counts = _worker_searcher.extract_cache.drain() if _worker_searcher.extract_cache is not None else None
+    return filename, status, _worker_searcher.results.drain(), _worker_searcher.log.drain(), segments, cache_counts, time() - start, timings, mime, _worker_searcher._prefiltered
+
 def main():
     # Variables & instantiation 
     working_dir = "D:\\WorkingDir" # Base directory we are working from
     original_dir = "D:\\WorkingDir\\SearchDir" # Directory containing the files of interest
     keywords_file = "D:\\WorkingDir\\keywords.txt" # File containing the keywords which will be searched for
-    estimated_files = 1000000
 
-    fs = FileSearcher(working_dir, original_dir, keywords_file, estimated_files=estimated_files)
+    fs = FileSearcher(working_dir, original_dir, keywords_file)
 
     # Create Required Directories
     fs.create_dirs()
 
-    ##Preliminary check for compressed files. Saves some processing time to do a first pass through the directory (non recursive) and uncompress files.
-    ##If additional compressed files are found during processing, they will be handled as well. However, the loop gets restarted to handle the newly uncompressed files.
-    # fs.uncompress_tar_flevel(original_dir)
-
-    ##Get file statistics if needed, this is time consuming.
-    # fs.get_filetype_stats(searchme)
-    
-    ##Optionally, group the files by file exention. 
-    # fs.group_by_extension()
+    ##Archives are searched in place unless stream_archives is turned off, in which case they are extracted as the search finds them.
+    ##uncompress_tar_flevel, get_filetype_stats and group_by_extension still work as separate passes, but each walks the whole tree again.
 
     ##Declare what we are searching
-    searchme = original_dir # Likely either going to use the 'original_dir' or the Grouped file directory.
+    searchme = original_dir
     ##Search
     fs.process_directory(searchme)
+    ##Or search with a process per core, a file count up front for the progress bar and the file type stats collected in the same pass.
+    ##Add group=True to sort the moved files by extension.
+    # fs.process_directory(searchme, workers=os.cpu_count(), precount=True, stats=True)
     ##Delete any empty directories
     fs.cleanup_directories(searchme)
+    ##Flush and close the results
+    fs.close()
     
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Search unstructured directories and files for keywords.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help="Search for a keyword list in the index built by a run with index=True.")
+    query.add_argument('index_file', help="Output/index.db from the run that built the index")
+    query.add_argument('keywords_file', help="New line delimited file of keywords")
+    query.add_argument('--results-dir', default="Results", help="Directory the results are written to (default: %(default)s)")
+    query.add_argument('--results-backend', choices=FileSearcher.results_backends, default='text')
+    shard = commands.add_parser('shard', help="Search one partition of a directory, run once per shard on any number of hosts.")
+    shard.add_argument('working_dir', help="Directory for this shard's Output bundle, one per shard")
+    shard.add_argument('search_dir', help="Directory being searched, the same path for every shard")
+    shard.add_argument('keywords_file', help="New line delimited file of keywords")
+    shard.add_argument('--shard', type=int, required=True, help="Index of this shard, from 0")
+    shard.add_argument('--shards', type=int, required=True, help="Number of shards")
+    shard.add_argument('--shard-by', choices=TreeWalker.shard_modes, default='path', help="Partition by file path or by top level directory (default: %(default)s)")
+    shard.add_argument('--workers', type=int, default=os.cpu_count())
+    shard.add_argument('--results-backend', choices=FileSearcher.results_backends, default='text')
+    shard.add_argument('--manifest', action='store_true', help="Keep a manifest so the shard can be run again after a crash")
+    shard.add_argument('--read-only', action='store_true', help="Leave the search directory untouched")
+    merge = commands.add_parser('merge', help="Combine the Output bundles of a sharded scan.")
+    merge.add_argument('output_dir', help="Directory the merged Results, manifest and stats are written to")
+    merge.add_argument('bundle_dirs', nargs='+', help="Output directory of each shard")
+    args = parser.parse_args(argv)
+
+    if args.command == 'shard':
+        os.makedirs(args.working_dir, exist_ok=True)
+        fs = FileSearcher(args.working_dir, args.search_dir, args.keywords_file, results_backend=args.results_backend, manifest=args.manifest,
+                          read_only=args.read_only, walker=TreeWalker(shard=(args.shard, args.shards), shard_by=args.shard_by))
+        fs.create_dirs()
+        try:
+            fs.process_directory(args.search_dir, workers=args.workers, stats=True)
+        finally:
+            fs.close()
+    elif args.command == 'merge':
+        try:
+            summary = merge_bundles(args.bundle_dirs, args.output_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        print("Merged shards {} of {} in to {}, {} files searched".format(summary['merged'], summary['shards'], args.output_dir, summary['completed']))
+        if summary['missing']:
+            print("Missing shards: {}".format(summary['missing']))
+
+    elif args.command == 'query':
+        if not os.path.isfile(args.index_file):
+            parser.error("no index at {}".format(args.index_file))
+        os.makedirs(args.results_dir, exist_ok=True)
+        start = time()
+        index = TextIndex(args.index_file)
+        results = open_results_sink(args.results_dir, args.results_backend)
+        hits = 0
+        try:
+            for record in index.search(read_keywords(args.keywords_file)):
+                results.write(*record)
+                hits += 1
+        finally:
+            results.close()
+            index.close()
+        print("{} hits written to {} in {:.2f}s".format(hits, args.results_dir, time() - start))
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        cli()
+    else:
+        main()
@@ -0,0 +1,477 @@
+"""
+Benchmarks for FileSearcher on a generated corpus, so changes can be measured against each other.
+
+    python benchmark.py generate BenchCorpus --files 2000 --seed 1
+    python benchmark.py run BenchCorpus --workers 4 --output before.json
+    python benchmark.py compare before.json after.json
+
+The corpus is the same for the same seed and settings, down to the bytes. Everything runs offline.
+"""
+#Built in libraries
+import os
+import sys
+import io
+import re
+import json
+import gzip
+import random
+import shutil
+import tarfile
+import zipfile
+import argparse
+import platform
+import tempfile
+import subprocess
+from time import time, perf_counter
+from html import escape
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+try:
+    import resource # POSIX only, used for the peak memory figures
+except ImportError:
+    resource = None
+
+#Third party libraries
+try:
+    import xlwt # Only needed to generate xls files, they are left out of the corpus without it
+except ImportError:
+    xlwt = None
+
+from FileSearcher import FileSearcher, FileType
+
+FIXED_MTIME = 1577836800 # 2020-01-01, given to every generated file and archive member
+FIXED_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+
+class CorpusGenerator:
+    """
+    Writes a deterministic synthetic corpus: plain text, xlsx, xls, docx, PDF and tar.gz archives holding a nested tar.gz,
+    spread over a few levels of directories, with some unicode and space filled file names.
+    Office and PDF files are written straight from their XML and PDF syntax so nothing in them depends on the time or library version.
+    mix maps each kind to its share of the files. A keywords file is written next to the corpus, hit_rate is the chance a
+    paragraph, row or line block contains one of them.
+    """
+    kinds = ('text', 'xlsx', 'xls', 'docx', 'pdf', 'tar.gz')
+    writers = {'text': ('_text', 'txt'), 'xlsx': ('_xlsx', 'xlsx'), 'xls': ('_xls', 'xls'), 'docx': ('_docx', 'docx'), 'pdf': ('_pdf', 'pdf'), 'tar.gz': ('_archive', 'tar.gz')} # Method and extension
+    default_mix = {'text': 40, 'xlsx': 15, 'xls': 10, 'docx': 15, 'pdf': 10, 'tar.gz': 10}
+    unicode_words = ("Zürich", "naïve", "résumé", "Ελληνικά", "данные", "日本語", "中文", "Ångström", "façade", "São Paulo")
+    unicode_names = ("_résumé", "_данные", "_文件", " copy", " (1)", "_Ελληνικά")
+
+    def __init__(self, seed=0, files=1000, mix=None, text_size=64 * 1024, keywords=20, hit_rate=0.05):
+        self.seed = seed
+        self.files = files
+        self.mix = dict(mix or self.default_mix)
+        unknown = set(self.mix) - set(self.kinds)
+        if unknown:
+            raise ValueError("unknown kinds in mix: {}".format(", ".join(sorted(unknown))))
+        if xlwt is None and self.mix.pop('xls', 0):
+            print("xlwt is not installed, the corpus has no xls files", file=sys.stderr)
+        self.text_size = text_size # Rough size of a text file, the other kinds are scaled from it
+        self.keyword_count = keywords
+        self.hit_rate = hit_rate
+
+    def settings(self):
+        return {'seed': self.seed, 'files': self.files, 'mix': self.mix, 'text_size': self.text_size, 'keywords': self.keyword_count, 'hit_rate': self.hit_rate}
+
+    def generate(self, directory):
+        """
+        Writes the corpus to directory/Corpus, the keywords to directory/keywords.txt and a description to directory/corpus.json.
+        Returns the description, which lists every file with its kind and size.
+        """
+        rng = random.Random(self.seed)
+        self.vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+        self.keywords = ["kw{}{}".format(index, "".join(rng.choice("qxzj") for _ in range(4))) for index in range(self.keyword_count)]
+        corpus_dir = os.path.join(directory, "Corpus")
+        if os.path.exists(corpus_dir):
+            shutil.rmtree(corpus_dir)
+        os.makedirs(corpus_dir)
+        with open(os.path.join(directory, "keywords.txt"), 'w', encoding='utf-8') as file:
+            file.write("\n".join(self.keywords) + "\n")
+
+        kinds = [kind for kind, share in sorted(self.mix.items()) for _ in range(share)]
+        listing = []
+        for index in range(self.files):
+            kind = rng.choice(kinds)
+            name = "{}_{:05d}".format(kind.split(".")[0], index)
+            if rng.random() < 0.1:
+                name += rng.choice(self.unicode_names)
+            subdir = os.path.join("d{:02d}".format(rng.randrange(16)), "s{}".format(rng.randrange(4)))
+            writer, extension = self.writers[kind]
+            path = os.path.join(corpus_dir, subdir, name + "." + extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = getattr(self, writer)(rng)
+            with open(path, 'wb') as file:
+                file.write(data)
+            os.utime(path, (FIXED_MTIME, FIXED_MTIME))
+            listing.append({'path': os.path.relpath(path, corpus_dir), 'kind': kind, 'size': len(data)})
+
+        description = {'settings': self.settings(), 'files': listing, 'bytes': sum(item['size'] for item in listing)}
+        with open(os.path.join(directory, "corpus.json"), 'w', encoding='utf-8') as file:
+            json.dump(description, file, indent=1, ensure_ascii=False)
+        return description
+
+    def _sentence(self, rng, words=12, ascii_only=False):
+        sentence = [rng.choice(self.vocabulary) for _ in range(words)]
+        if not ascii_only and rng.random() < 0.2:
+            sentence[rng.randrange(words)] = rng.choice(self.unicode_words)
+        if rng.random() < self.hit_rate:
+            sentence[rng.randrange(words)] = rng.choice(self.keywords)
+        return " ".join(sentence)
+
+    def _text(self, rng):
+        lines, size = [], 0
+        target = rng.randint(self.text_size // 2, self.text_size * 3 // 2)
+        while size < target:
+            line = self._sentence(rng)
+            lines.append(line)
+            size += len(line.encode('utf-8')) + 1
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    @staticmethod
+    def _zip(parts):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in parts:
+                info = zipfile.ZipInfo(name, FIXED_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, content)
+        return buffer.getvalue()
+
+    def _xlsx(self, rng):
+        rows = rng.randint(self.text_size // 400, self.text_size // 100)
+        strings, cells = [], []
+        for row in range(1, rows + 1):
+            cells.append('<row r="{}">'.format(row))
+            for column in "ABCDEF":
+                if column in "AB":
+                    cells.append('<c r="{}{}"><v>{}</v></c>'.format(column, row, rng.randint(0, 100000)))
+                else:
+                    strings.append(self._sentence(rng, words=4))
+                    cells.append('<c r="{}{}" t="s"><v>{}</v></c>'.format(column, row, len(strings) - 1))
+            cells.append('</row>')
+        main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+        relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+        return self._zip([
+            ("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+                '</Types>'),
+            ("_rels/.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="{}/officeDocument" Target="xl/workbook.xml"/></Relationships>'.format(relationships)),
+            ("xl/workbook.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<workbook xmlns="{}" xmlns:r="{}"><sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'.format(main, relationships)),
+            ("xl/_rels/workbook.xml.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="{0}/worksheet" Target="worksheets/sheet1.xml"/>'
+                '<Relationship Id="rId2" Type="{0}/sharedStrings" Target="sharedStrings.xml"/></Relationships>'.format(relationships)),
+            ("xl/sharedStrings.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><sst xmlns="{}" count="{}" uniqueCount="{}">{}</sst>'.format(
+                main, len(strings), len(strings), "".join("<si><t>{}</t></si>".format(escape(text, quote=False)) for text in strings))),
+            ("xl/worksheets/sheet1.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="{}"><dimension ref="A1:F{}"/><sheetData>{}</sheetData></worksheet>'.format(main, rows, "".join(cells))),
+        ])
+
+    def _xls(self, rng):
+        workbook = xlwt.Workbook(encoding='utf-8')
+        sheet = workbook.add_sheet("Sheet1")
+        for row in range(rng.randint(self.text_size // 400, self.text_size // 100)):
+            sheet.write(row, 0, rng.randint(0, 100000))
+            for column in range(1, 5):
+                sheet.write(row, column, self._sentence(rng, words=4))
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+    def _docx(self, rng):
+        def paragraph(text):
+            return '<w:p><w:r><w:t xml:space="preserve">{}</w:t></w:r></w:p>'.format(escape(text, quote=False))
+        body = []
+        size, target = 0, rng.randint(self.text_size // 2, self.text_size * 3 // 2)
+        while size < target:
+            if rng.random() < 0.05:
+                rows = "".join("<w:tr>{}</w:tr>".format("".join("<w:tc>{}</w:tc>".format(paragraph(self._sentence(rng, words=3))) for _ in range(3))) for _ in range(4))
+                body.append("<w:tbl>{}</w:tbl>".format(rows))
+            else:
+                text = self._sentence(rng)
+                body.append(paragraph(text))
+                size += len(text)
+        word = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+        relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+        return self._zip([
+            ("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                '<Override PartName="/word/header1.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.header+xml"/>'
+                '</Types>'),
+            ("_rels/.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="{}/officeDocument" Target="word/document.xml"/></Relationships>'.format(relationships)),
+            ("word/_rels/document.xml.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="{}/header" Target="header1.xml"/></Relationships>'.format(relationships)),
+            ("word/document.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document {}><w:body>{}<w:sectPr><w:headerReference w:type="default" r:id="rId1"/></w:sectPr></w:body></w:document>'.format(word, "".join(body))),
+            ("word/header1.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:hdr {}>{}</w:hdr>'.format(word, paragraph(self._sentence(rng, words=4)))),
+        ])
+
+    def _pdf(self, rng):
+        pages = []
+        for _ in range(rng.randint(1, max(1, self.text_size // 8192))):
+            lines = [self._sentence(rng, words=8, ascii_only=True) for _ in range(50)]
+            text = "".join("({}) '\n".format(re.sub(r"([()\\])", r"\\\1", line)) for line in lines)
+            pages.append("BT /F1 10 Tf 14 TL 40 800 Td\n{}ET".format(text).encode('ascii'))
+        # Objects: 1 catalog, 2 page tree, 3 font, then a page and its content stream for each page
+        page_ids = [4 + 2 * index for index in range(len(pages))]
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            "<< /Type /Pages /Kids [{}] /Count {} >>".format(" ".join("{} 0 R".format(page) for page in page_ids), len(pages)).encode('ascii'),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        ]
+        for page, content in zip(page_ids, pages):
+            objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>".format(page + 1).encode('ascii'))
+            objects.append(b"<< /Length " + str(len(content)).encode('ascii') + b" >>\nstream\n" + content + b"\nendstream")
+        output = io.BytesIO()
+        output.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(output.tell())
+            output.write(str(number).encode('ascii') + b" 0 obj\n" + body + b"\nendobj\n")
+        xref = output.tell()
+        output.write("xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1).encode('ascii'))
+        for offset in offsets:
+            output.write("{:010d} 00000 n \n".format(offset).encode('ascii'))
+        output.write("trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n".format(len(objects) + 1, xref).encode('ascii'))
+        return output.getvalue()
+
+    @staticmethod
+    def _tar_gz(members):
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename="", mode='wb', fileobj=buffer, mtime=0) as compressed:
+            with tarfile.open(fileobj=compressed, mode='w', format=tarfile.PAX_FORMAT) as archive:
+                for name, data in members:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = FIXED_MTIME
+                    archive.addfile(info, io.BytesIO(data))
+        return buffer.getvalue()
+
+    def _archive(self, rng):
+        inner = self._tar_gz([("notes/inner_{}.txt".format(index), self._text(rng)) for index in range(2)] + [("report.docx", self._docx(rng))])
+        members = [("logs/log_{}.txt".format(index), self._text(rng)) for index in range(rng.randint(1, 3))]
+        members.append(("données/résumé.txt", self._text(rng)))
+        members.append(("nested/inner.tar.gz", inner))
+        return self._tar_gz(members)
+
+# Search method benchmarked on its own for each kind of file, with the extra arguments it needs
+search_methods = {
+    'text': ('_search_plaintext', ()),
+    'xlsx': ('_search_excel', ()),
+    'xls': ('_search_excel_old_format', ()),
+    'docx': ('_search_word_docx', ()),
+    'pdf': ('_search_pdf', ()),
+    'tar.gz': ('_search_archive', (FileType.GZIP,)),
+}
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of a list of numbers, None for an empty list.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def peak_rss():
+    """
+    Peak resident memory in MB of this process and of the largest child it has waited for, None without the resource module.
+    """
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is bytes on macOS, KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+def summarize(files, size, seconds, latencies, hits):
+    peak, peak_children = peak_rss()
+    return {
+        'files': files,
+        'bytes': size,
+        'seconds': round(seconds, 4),
+        'files_per_s': round(files / seconds, 2) if seconds else None,
+        'mb_per_s': round(size / seconds / 1024 / 1024, 3) if seconds else None,
+        'peak_rss_mb': peak and round(peak, 1),
+        'peak_child_rss_mb': peak_children and round(peak_children, 1),
+        'latency_p50_ms': latencies and round(percentile(latencies, 0.5) * 1000, 3),
+        'latency_p99_ms': latencies and round(percentile(latencies, 0.99) * 1000, 3),
+        'hits': hits,
+    }
+
+def _count_hits(results_dir):
+    with open(os.path.join(results_dir, "results.jsonl"), 'rb') as file:
+        return sum(1 for _ in file)
+
+def _run_process_directory(corpus_dir, description, workers, options):
+    """
+    Runs process_directory over a copy of the corpus, it moves the files it searches. The log keeps its default verbosity,
+    a record per file would add to the time being measured, so per file latencies only come from the search method cases.
+    """
+    with tempfile.TemporaryDirectory(prefix="fs_bench_") as working_dir:
+        search_dir = os.path.join(working_dir, "Corpus")
+        shutil.copytree(os.path.join(corpus_dir, "Corpus"), search_dir)
+        fs = FileSearcher(working_dir, search_dir, os.path.join(corpus_dir, "keywords.txt"), results_backend='jsonl', **options)
+        fs.create_dirs()
+        start = perf_counter()
+        fs.process_directory(search_dir, workers=workers)
+        fs.close()
+        seconds = perf_counter() - start
+        return summarize(len(description['files']), description['bytes'], seconds, None, _count_hits(fs.results_dir))
+
+def _run_method(corpus_dir, description, kind, options):
+    """
+    Calls the search method for one kind of file directly on every file of that kind, timing each call.
+    """
+    method_name, arguments = search_methods[kind]
+    files = [item for item in description['files'] if item['kind'] == kind]
+    with tempfile.TemporaryDirectory(prefix="fs_bench_") as working_dir:
+        fs = FileSearcher(working_dir, corpus_dir, os.path.join(corpus_dir, "keywords.txt"), results_backend='jsonl', **options)
+        fs.create_dirs()
+        method = getattr(fs, method_name)
+        latencies = []
+        start = perf_counter()
+        for item in files:
+            started = perf_counter()
+            method(os.path.join(corpus_dir, "Corpus", item['path']), *arguments)
+            latencies.append(perf_counter() - started)
+        fs.close()
+        seconds = perf_counter() - start
+        return summarize(len(files), sum(item['size'] for item in files), seconds, latencies, _count_hits(fs.results_dir))
+
+def run_case(corpus_dir, case, workers=1, options=None):
+    """
+    Runs one benchmark case: 'process_directory' or the name of a kind of file, whose search method is timed on its own.
+    Meant to run in a fresh process so the peak memory belongs to the case.
+    """
+    with open(os.path.join(corpus_dir, "corpus.json"), encoding='utf-8') as file:
+        description = json.load(file)
+    if case == 'process_directory':
+        return _run_process_directory(corpus_dir, description, workers, options or {})
+    return _run_method(corpus_dir, description, case, options or {})
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(corpus_dir, workers=(1,), cases=None, repeat=1, options=None):
+    """
+    Runs every case over a generated corpus, each in its own spawned process, and returns the results with details of the machine.
+    workers lists the worker counts process_directory is run with. With repeat above one the fastest run of each case is kept.
+    options are keyword arguments for FileSearcher, such as {'pdf_backend': 'pdftotext'}.
+    """
+    with open(os.path.join(corpus_dir, "corpus.json"), encoding='utf-8') as file:
+        description = json.load(file)
+    kinds = sorted(set(item['kind'] for item in description['files']))
+    if cases is None:
+        cases = ['process_directory'] + kinds
+    runs = [(case, count) for case in cases for count in (workers if case == 'process_directory' else (1,))]
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for case, count in runs:
+        name = case if case != 'process_directory' else "process_directory[workers={}]".format(count)
+        best = None
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_case, corpus_dir, case, count, options).result()
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[name] = best
+        print("{:<32} {:>8} files {:>10} files/s {:>9} MB/s  p50 {} ms  p99 {} ms  peak {} MB".format(
+            name, best['files'], best['files_per_s'], best['mb_per_s'], best['latency_p50_ms'], best['latency_p99_ms'], best['peak_rss_mb']))
+    return {
+        'created': time(),
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': {'directory': os.path.abspath(corpus_dir), 'settings': description['settings'], 'files': len(description['files']), 'bytes': description['bytes']},
+        'options': options or {},
+        'repeat': repeat,
+        'cases': results,
+    }
+
+def compare(before, after):
+    """
+    Prints the change in throughput, latency and memory for the cases two result files share.
+    """
+    if before['corpus']['settings'] != after['corpus']['settings']:
+        print("Warning: the runs used different corpus settings")
+    print("{:<32} {:>12} {:>12} {:>8} {:>12} {:>12} {:>10}".format("case", "files/s", "files/s", "speedup", "p99 ms", "p99 ms", "peak MB"))
+    for name in before['cases']:
+        if name not in after['cases']:
+            continue
+        old, new = before['cases'][name], after['cases'][name]
+        speedup = new['files_per_s'] / old['files_per_s'] if old['files_per_s'] and new['files_per_s'] else None
+        print("{:<32} {:>12} {:>12} {:>8} {:>12} {:>12} {:>10}".format(
+            name, str(old['files_per_s']), str(new['files_per_s']), "{:.2f}x".format(speedup) if speedup else "-",
+            str(old['latency_p99_ms']), str(new['latency_p99_ms']), "{} -> {}".format(old['peak_rss_mb'], new['peak_rss_mb'])))
+        if old['hits'] != new['hits']:
+            print("{:<32} hits changed from {} to {}".format("", old['hits'], new['hits']))
+
+def parse_mix(text):
+    """
+    Parses 'text=40,pdf=10' in to {'text': 40, 'pdf': 10}.
+    """
+    mix = {}
+    for item in text.split(","):
+        kind, _, share = item.partition("=")
+        mix[kind.strip()] = int(share)
+    return mix
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic corpus and benchmark FileSearcher on it.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help="Write a corpus, its keywords and corpus.json to a directory.")
+    generate.add_argument('directory')
+    generate.add_argument('--files', type=int, default=1000)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--mix', type=parse_mix, default=None, help="Share of each kind, e.g. text=40,xlsx=15,xls=10,docx=15,pdf=10,tar.gz=10")
+    generate.add_argument('--text-size', type=int, default=64 * 1024, help="Rough bytes of text per file (default: %(default)s)")
+    generate.add_argument('--keywords', type=int, default=20)
+    generate.add_argument('--hit-rate', type=float, default=0.05)
+    run = commands.add_parser('run', help="Benchmark process_directory and each search method on a generated corpus.")
+    run.add_argument('directory', help="Directory written by generate")
+    run.add_argument('--workers', type=int, nargs='+', default=[1], help="Worker counts to run process_directory with")
+    run.add_argument('--cases', nargs='+', choices=['process_directory'] + list(CorpusGenerator.kinds))
+    run.add_argument('--repeat', type=int, default=1, help="Runs of each case, the fastest is kept")
+    run.add_argument('--pdf-backend', default='pypdf2')
+    run.add_argument('--output', help="JSON file the results are written to")
+    compare_runs = commands.add_parser('compare', help="Compare two result files.")
+    compare_runs.add_argument('before')
+    compare_runs.add_argument('after')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generator = CorpusGenerator(seed=args.seed, files=args.files, mix=args.mix, text_size=args.text_size, keywords=args.keywords, hit_rate=args.hit_rate)
+        start = time()
+        description = generator.generate(args.directory)
+        print("{} files, {} bytes written to {} in {:.2f}s".format(len(description['files']), description['bytes'], args.directory, time() - start))
+    elif args.command == 'run':
+        if not os.path.isfile(os.path.join(args.directory, "corpus.json")):
+            parser.error("no corpus in {}, run generate first".format(args.directory))
+        results = run_benchmarks(args.directory, workers=args.workers, cases=args.cases, repeat=args.repeat, options={'pdf_backend': args.pdf_backend})
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=1)
+            print("Results written to {}".format(args.output))
+    else:
+        with open(args.before, encoding='utf-8') as before, open(args.after, encoding='utf-8') as after:
+            compare(json.load(before), json.load(after))
+
+if __name__ == "__main__":
+    cli()
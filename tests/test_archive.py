@@ -0,0 +1,51 @@
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FileSearcher import FileSearcher
+
+
+class ArchiveMemberNameTest(unittest.TestCase):
+    """
+    Archive and member names can hold the '!' used to join them in the results.
+    """
+
+    def search(self, archive_name, members):
+        with tempfile.TemporaryDirectory() as working_dir:
+            search_dir = os.path.join(working_dir, "Search")
+            os.mkdir(search_dir)
+            with zipfile.ZipFile(os.path.join(search_dir, archive_name), 'w') as archive:
+                for name, data in members.items():
+                    archive.writestr(name, data)
+            keywords_file = os.path.join(working_dir, "keywords.txt")
+            with open(keywords_file, 'w', encoding='utf-8') as file:
+                file.write("SECRETWORD\n")
+            fs = FileSearcher(working_dir, search_dir, keywords_file, results_backend='jsonl', read_only=True)
+            fs.create_dirs()
+            try:
+                fs.process_directory(search_dir)
+            finally:
+                fs.close()
+            with open(os.path.join(working_dir, "Output", "Results", "results.jsonl"), encoding='utf-8') as file:
+                return [os.path.relpath(json.loads(line)['path'], search_dir) for line in file]
+
+    def test_compressed_member(self):
+        paths = self.search("old!backup.zip", {"logs!2020/run!1.log.gz": gzip.compress(b"a SECRETWORD here\n")})
+        self.assertEqual(paths, ["old!backup.zip!logs!2020/run!1.log.gz!run!1.log"])
+
+    def test_nested_archive(self):
+        inner = io.BytesIO()
+        with zipfile.ZipFile(inner, 'w') as archive:
+            archive.writestr("note!.txt", "SECRETWORD")
+        paths = self.search("outer.zip", {"in!ner.zip": inner.getvalue()})
+        self.assertEqual(paths, ["outer.zip!in!ner.zip!note!.txt"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FileSearcher import KeywordMatcher
+
+
+class KeywordMatcherCaseTest(unittest.TestCase):
+    """
+    Literal keywords have to match the same text re.search(keyword, text, re.IGNORECASE) does.
+    """
+
+    def assertSameAsRe(self, keyword, text):
+        expected = {keyword} if re.search(re.escape(keyword), text, re.IGNORECASE) else set()
+        self.assertEqual(KeywordMatcher([keyword]).search(text), expected, (keyword, text))
+
+    def test_dotted_capital_i(self):
+        self.assertEqual(KeywordMatcher(["istanbul"]).search("İSTANBUL"), {"istanbul"})
+        self.assertEqual(KeywordMatcher(["İstanbul"]).search("istanbul"), {"İstanbul"})
+
+    def test_other_case_equivalents(self):
+        for keyword, text in (("ask", "aſk"), ("οδοσ", "ΟΔΟΣ"), ("ΟΔΟΣ", "οδος"), ("kelvin", "Kelvin"), ("μ", "µ"), ("strasse", "STRASSE"), ("straße", "STRASSE")):
+            self.assertSameAsRe(keyword, text)
+
+    def test_every_equivalent_character(self):
+        characters = {chr(character) for character in KeywordMatcher.case_folds} | set(KeywordMatcher.case_folds.values()) | {"İ"}
+        for keyword in characters:
+            for character in characters:
+                self.assertSameAsRe("x" + keyword, "X" + character.upper())
+                self.assertSameAsRe("x" + keyword, "x" + character)
+
+    def test_might_match_agrees(self):
+        matcher = KeywordMatcher(["istanbul"])
+        self.assertTrue(matcher.might_match(["İSTANBUL"]))
+        self.assertFalse(matcher.might_match(["ANKARA"]))
+
+    def test_might_match_across_short_pieces(self):
+        # Pieces shorter than the literal, such as one short paragraph after another in a prefiltered document
+        matcher = KeywordMatcher(["istanbul"])
+        self.assertTrue(matcher.might_match(["x", "İS", "TAN", "B", "UL"]))
+        self.assertFalse(matcher.might_match(["İS", "TAN", "-", "BUL"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FileSearcher import FileSearcher
+
+
+class PlaintextTest(unittest.TestCase):
+    """
+    Text files searched through the decoded path, which runs for files with a byte order mark and for
+    keyword lists that can't be matched as raw bytes.
+    """
+
+    def search(self, data, keywords, chunk_size=None):
+        with tempfile.TemporaryDirectory() as working_dir:
+            search_dir = os.path.join(working_dir, "Search")
+            os.mkdir(search_dir)
+            path = os.path.join(search_dir, "file.txt")
+            with open(path, 'wb') as file:
+                file.write(data)
+            keywords_file = os.path.join(working_dir, "keywords.txt")
+            with open(keywords_file, 'w', encoding='utf-8') as file:
+                file.write("\n".join(keywords) + "\n")
+            fs = FileSearcher(working_dir, search_dir, keywords_file, results_backend='jsonl', read_only=True)
+            if chunk_size is not None:
+                fs.plaintext_chunk_size = chunk_size
+            fs.create_dirs()
+            try:
+                self.assertTrue(fs._search_plaintext(path))
+            finally:
+                fs.close()
+            with open(os.path.join(working_dir, "Output", "Results", "results.jsonl"), encoding='utf-8') as file:
+                return [json.loads(line) for line in file]
+
+    def test_long_line(self):
+        # One 4MB line with hits at both ends, matched in windows instead of being decoded whole
+        line = "year 1999 " + "abc def " * (512 * 1024) + "year 2000 END"
+        chunk_size = 64 * 1024
+        hits = self.search(line.encode('utf-8'), [r"\d{4}", "END$"], chunk_size=chunk_size)
+        self.assertEqual(sorted(hit['keyword'] for hit in hits), ["END$", r"\d{4}"])
+        self.assertTrue(all(hit['location'] == "line 1" for hit in hits))
+        self.assertTrue(all(len(hit['context']) < 4 * chunk_size for hit in hits))
+
+    def test_end_of_line_before_crlf(self):
+        hits = self.search(b"hello error\r\nerror here\r\nlast error", ["error$"])
+        self.assertEqual(sorted(hit['location'] for hit in hits), ["line 1", "line 3"])
+
+    def test_start_of_line_after_crlf(self):
+        hits = self.search(b"an error\r\nerror here\r\n", ["^error"])
+        self.assertEqual([hit['location'] for hit in hits], ["line 2"])
+
+    def test_long_line_with_byte_order_mark(self):
+        line = "abc def " * (512 * 1024) + "été 1999\nnext line"
+        hits = self.search(line.encode('utf-16'), ["ÉTÉ", "next"], chunk_size=64 * 1024)
+        self.assertEqual(sorted((hit['keyword'], hit['location']) for hit in hits), [("next", "line 2"), ("ÉTÉ", "line 1")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FileSearcher import FileSearcher
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>"""
+
+RELATIONSHIPS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/></Relationships>"""
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" xmlns:wps="http://schemas.microsoft.com/office/word/2010/wordprocessingShape" xmlns:v="urn:schemas-microsoft-com:vml"><w:body><w:p><w:r><w:t>Nothing here</w:t></w:r></w:p>{}</w:body></w:document>"""
+
+# A text box in the middle of a paragraph. Its text comes out as a paragraph of its own, so the text either side joins up.
+TEXT_BOX = """<w:p><w:r><w:t>SECR</w:t></w:r><w:r><w:pict><v:shape><v:textbox><w:txbxContent><w:p><w:r><w:t>box</w:t></w:r></w:p></w:txbxContent></v:textbox></v:shape></w:pict></w:r><w:r><w:t>ETWORD</w:t></w:r></w:p>"""
+
+# The same box as Word writes it, once for newer readers and again in the fallback copy
+ALTERNATE_CONTENT = """<w:p><w:r><w:t>SECR</w:t></w:r><w:r><mc:AlternateContent><mc:Choice Requires="wps"><w:drawing><wps:txbx><w:txbxContent><w:p><w:r><w:t>box</w:t></w:r></w:p></w:txbxContent></wps:txbx></w:drawing></mc:Choice><mc:Fallback><w:pict><v:shape><v:textbox><w:txbxContent><w:p><w:r><w:t>box</w:t></w:r></w:p></w:txbxContent></v:textbox></v:shape></w:pict></mc:Fallback></mc:AlternateContent></w:r><w:r><w:t>ETWORD</w:t></w:r></w:p>"""
+
+
+class PrefilterTextBoxTest(unittest.TestCase):
+    """
+    The prefilter mustn't rule out a Word file whose hit only appears once a text box is taken out of its paragraph.
+    """
+
+    def search(self, body, prefilter):
+        with tempfile.TemporaryDirectory() as working_dir:
+            search_dir = os.path.join(working_dir, "Search")
+            os.mkdir(search_dir)
+            with zipfile.ZipFile(os.path.join(search_dir, "box.docx"), 'w') as archive:
+                archive.writestr("[Content_Types].xml", CONTENT_TYPES)
+                archive.writestr("_rels/.rels", RELATIONSHIPS)
+                archive.writestr("word/document.xml", DOCUMENT.format(body))
+            keywords_file = os.path.join(working_dir, "keywords.txt")
+            with open(keywords_file, 'w', encoding='utf-8') as file:
+                file.write("SECRETWORD\n")
+            fs = FileSearcher(working_dir, search_dir, keywords_file, results_backend='jsonl', prefilter=prefilter)
+            fs.create_dirs()
+            try:
+                fs.process_directory(search_dir)
+            finally:
+                fs.close()
+            with open(os.path.join(working_dir, "Output", "Results", "results.jsonl"), encoding='utf-8') as file:
+                return [json.loads(line)['keyword'] for line in file], fs.prefilter_skipped
+
+    def test_text_box(self):
+        self.assertEqual(self.search(TEXT_BOX, prefilter=False)[0], ["SECRETWORD"])
+        hits, skipped = self.search(TEXT_BOX, prefilter=True)
+        self.assertEqual(hits, ["SECRETWORD"])
+        self.assertFalse(any(skipped.values()))
+
+    def test_text_box_with_fallback(self):
+        self.assertEqual(self.search(ALTERNATE_CONTENT, prefilter=False)[0], ["SECRETWORD"])
+        hits, skipped = self.search(ALTERNATE_CONTENT, prefilter=True)
+        self.assertEqual(hits, ["SECRETWORD"])
+        self.assertFalse(any(skipped.values()))
+
+    def test_clean_file_is_skipped(self):
+        hits, skipped = self.search("<w:p><w:r><w:t>SECRET WORD</w:t></w:r></w:p>", prefilter=True)
+        self.assertEqual(hits, [])
+        self.assertEqual(sum(skipped.values()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()